@@ -0,0 +1,47 @@
+import time
+from threading import Lock
+
+
+class ClientRegistry:
+    """Keeps API clients (and their keep-alive connection pools) alive between requests."""
+
+    def __init__(self, factory, idle_timeout=600, max_clients=256):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.max_clients = max_clients
+        self.clients = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            self._evict_idle(time.time())
+            if key in self.clients:
+                client, _ = self.clients[key]
+                self.clients[key] = (client, time.time())
+                return client
+
+        # Creating a client may hit the network, don't block the other threads meanwhile
+        client = self.factory(key)
+        with self.lock:
+            if key in self.clients:
+                self._close(client)
+                client, _ = self.clients[key]
+            elif len(self.clients) >= self.max_clients:
+                self._evict_oldest()
+            self.clients[key] = (client, time.time())
+            return client
+
+    def _evict_idle(self, now):
+        for key, (client, last_used) in list(self.clients.items()):
+            if now - last_used > self.idle_timeout:
+                self._close(self.clients.pop(key)[0])
+
+    def _evict_oldest(self):
+        oldest_key = min(self.clients, key=lambda key: self.clients[key][1])
+        self._close(self.clients.pop(oldest_key)[0])
+
+    @staticmethod
+    def _close(client):
+        close = getattr(client, 'close', None)
+        if close:
+            close()
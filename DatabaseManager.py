@@ -1,67 +1,286 @@
+import re
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from sqlite3.dbapi2 import Date
+from threading import Lock
 
 import pymongo
+from blinker import signal
 from bson import ObjectId
 from cryptography.fernet import Fernet
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# sent with changes={email: points delta} after users' points were updated
+points_changed = signal('points-changed')
+
+
+def normalize_search_text(text):
+    # 'Růžička' -> 'ruzicka'
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def get_search_tokens(user):
+    text = '{} {} {}'.format(user.get('fullname', ''), user['email'], user['email'].split('@')[0].replace('.', ' '))
+    return sorted(set(normalize_search_text(text).split()))
+
+
+class NotEnoughPointsException(Exception):
+    def __init__(self, message):
+        self.message = message
 
 
 class DatabaseManager:
     DATABASE_NAME = "SynePointsDb"
 
+    # collection -> index keys, every query below should be covered by one of these
+    INDEXES = {
+        'users': [
+            [('email', pymongo.ASCENDING)],
+            [('points', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)],
+            [('team', pymongo.ASCENDING)],
+            [('search_tokens', pymongo.ASCENDING)],
+        ],
+        'prizes': [
+            [('id', pymongo.ASCENDING)],
+        ],
+        'requests': [
+            [('email', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+            [('granted', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+        ],
+        'records': [
+            [('user', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+            [('request_id', pymongo.ASCENDING)],
+        ],
+        'points_buckets': [
+            [('period', pymongo.ASCENDING), ('points', pymongo.DESCENDING), ('user', pymongo.ASCENDING)],
+        ],
+        'balance_snapshots': [
+            [('run', pymongo.DESCENDING), ('user', pymongo.ASCENDING)],
+        ],
+        'teams': [
+            [('id', pymongo.ASCENDING)],
+        ],
+    }
+    # seconds
+    SNAPSHOT_MARGIN = 60
+    BULK_WRITE_SIZE = 1000
+    OPENING_BALANCE_REASON = 'Opening balance'
+
+    # fields rendered by the list pages
+    # _id stays in USER_LIST_FIELDS, the user pages are keyed by it
+    USER_LIST_FIELDS = {'email': 1, 'fullname': 1, 'points': 1}
+    REQUEST_LIST_FIELDS = {'email': 1, 'prize_id': 1, 'granted': 1}
+
+    # only documents having the field are indexed, so older documents without it don't collide
+    UNIQUE_INDEXES = {
+        'requests': ['client_token'],
+    }
+    UNIQUE_COMPOUND_INDEXES = {
+        'points_buckets': [[('period', pymongo.ASCENDING), ('user', pymongo.ASCENDING)]],
+    }
+
+    # prizes, rewards and teams rarely change, so they are kept in memory. Other workers learn about
+    # a change through the version stamps in the catalog_versions collection (requests have a stamp too).
+    CATALOGS = ('prizes', 'rewards', 'teams')
+    CATALOG_VERSION_CHECK_INTERVAL = 5
+
+    # decrypted API tokens, other workers pick up a changed token after the TTL at the latest
+    TOKEN_CACHE_TTL = 120
+    TOKEN_CACHE_SIZE = 256
+
     def __init__(self, database_uri, secret_key, use_test_data=False):
         self.client = MongoClient(host=database_uri)
         self.db = self.client[self.DATABASE_NAME]
         self.fernet = Fernet(secret_key)
+        self.catalog_cache = {}
+        self.catalog_versions = {}
+        self.catalog_versions_checked_at = 0
+        self.token_cache = OrderedDict()
+        self.token_cache_lock = Lock()
+        self.supports_transactions = self._supports_transactions()
+        self.ensure_indexes()
+        self.ensure_search_tokens()
+        self.ensure_points_buckets()
         if use_test_data:
             self._fill_db_with_test_data()
 
     def __del__(self):
         self.client.close()
 
+    def ensure_indexes(self):
+        # create_index is a no-op when the index already exists
+        for collection_name, indexes in self.INDEXES.items():
+            for keys in indexes:
+                self.db[collection_name].create_index(keys, background=True)
+        for collection_name, fields in self.UNIQUE_INDEXES.items():
+            for field in fields:
+                self.db[collection_name].create_index([(field, pymongo.ASCENDING)], unique=True, background=True,
+                                                      partialFilterExpression={field: {'$exists': True}})
+        for collection_name, indexes in self.UNIQUE_COMPOUND_INDEXES.items():
+            for keys in indexes:
+                self.db[collection_name].create_index(keys, unique=True, background=True)
+
+    def explain_queries(self):
+        """Explains the queries used by this class and returns the names of those doing a collection scan."""
+        cursors = {
+            'get_user': self.db.users.find({'email': ''}),
+            'get_all_users': self.get_all_users(),
+            'get_requests': self.get_requests(''),
+            'get_ungranted_requests': self.get_ungranted_requests(),
+            'query_users': self.query_users('a'),
+            'records': self.db.records.find({'user': ''}),
+        }
+        collection_scans = []
+        for name, cursor in cursors.items():
+            winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+            if self._has_stage(winning_plan, 'COLLSCAN'):
+                collection_scans.append(name)
+        return collection_scans
+
+    @classmethod
+    def _has_stage(cls, plan, stage):
+        if plan.get('stage') == stage:
+            return True
+        children = plan.get('inputStages', [])
+        if 'inputStage' in plan:
+            children = children + [plan['inputStage']]
+        return any(cls._has_stage(child, stage) for child in children)
+
+    def ensure_search_tokens(self):
+        # Users created before the search tokens existed (or added by hand) get them here, the lookup is indexed
+        for user in self.db.users.find({'search_tokens': {'$exists': False}}, {'email': 1, 'fullname': 1}):
+            self.db.users.update_one({'_id': user['_id']}, {'$set': {'search_tokens': get_search_tokens(user)}})
+
     def _store_user(self, user):
+        user['search_tokens'] = get_search_tokens(user)
+        if user.get('points'):
+            self.store_record({'change_by': None, 'user': user['email'], 'reason': self.OPENING_BALANCE_REASON,
+                               'points': user['points']})
         return self.db.users.insert_one(user)
 
     def get_user(self, email):
         query = {'email': email}
         return self.db.users.find_one(query)
 
-    def get_all_users(self):
-        return self.db.users.find().sort([('points', pymongo.DESCENDING)])
+    def get_all_users(self, projection=None, limit=0, after=None):
+        """Users sorted by points. Pass get_user_page_key of the last user of a page as after to get the next one."""
+        query = {}
+        if after:
+            points, _, user_id = after.partition(':')
+            if not points.lstrip('-').isdigit() or not ObjectId.is_valid(user_id):
+                raise ValueError('Invalid page key {}'.format(after))
+            points = int(points)
+            query = {'$or': [{'points': {'$lt': points}},
+                             {'points': points, '_id': {'$gt': ObjectId(user_id)}}]}
+        return self.db.users.find(query, projection).sort([('points', pymongo.DESCENDING),
+                                                           ('_id', pymongo.ASCENDING)]).limit(limit)
+
+    @staticmethod
+    def get_user_page_key(user):
+        return '{}:{}'.format(user['points'], user['_id'])
+
+    def _get_catalog(self, name):
+        version = self._get_catalog_version(name)
+        cached = self.catalog_cache.get(name)
+        if cached and cached[0] == version:
+            return cached[1]
+        catalog = list(self.db[name].find())
+        self.catalog_cache[name] = (version, catalog)
+        return catalog
+
+    def _get_catalog_version(self, name):
+        now = time.time()
+        if now - self.catalog_versions_checked_at > self.CATALOG_VERSION_CHECK_INTERVAL:
+            self.catalog_versions = {stamp['_id']: stamp for stamp in self.db.catalog_versions.find()}
+            self.catalog_versions_checked_at = now
+        return self.catalog_versions.get(name, {}).get('version', 0)
+
+    def get_versions(self, names, fresh=False):
+        """Returns ({name: version}, last modification) of the given collections.
+
+        Catalogs may be a few seconds behind other workers, pass fresh=True to read the stamps from the database.
+        """
+        if fresh:
+            stamps = {stamp['_id']: stamp for stamp in self.db.catalog_versions.find({'_id': {'$in': names}})}
+        else:
+            self._get_catalog_version(names[0])
+            stamps = self.catalog_versions
+        versions = {}
+        last_modified = None
+        for name in names:
+            stamp = stamps.get(name, {})
+            versions[name] = stamp.get('version', 0)
+            if stamp.get('updated_at') and (last_modified is None or stamp['updated_at'] > last_modified):
+                last_modified = stamp['updated_at']
+        return versions, last_modified
+
+    def _bump_version(self, name):
+        self.db.catalog_versions.update_one({'_id': name},
+                                            {'$inc': {'version': 1}, '$set': {'updated_at': datetime.utcnow()}},
+                                            upsert=True)
+
+    def _invalidate_catalog(self, name):
+        self._bump_version(name)
+        self.catalog_cache.pop(name, None)
+        self.catalog_versions_checked_at = 0
 
     def store_prize(self, prize):
-        return self.db.prizes.insert_one(prize)
+        result = self.db.prizes.insert_one(prize)
+        self._invalidate_catalog('prizes')
+        return result
 
     def get_all_prizes(self):
-        return self.db.prizes.find()
+        return list(self._get_catalog('prizes'))
 
     def store_jira_api_token(self, email, api_token):
         encrypted_token = self.fernet.encrypt(api_token.encode('UTF-8'))
-        return self.db.users.update({'email': email}, {'$set': {'jira_api_token': encrypted_token}})
+        result = self.db.users.update({'email': email}, {'$set': {'jira_api_token': encrypted_token}})
+        self._purge_api_token(email, 'jira_api_token')
+        return result
 
     def get_jira_api_token(self, email):
-        user = self.get_user(email)
-        if user:
-            if 'jira_api_token' in user:
-                encrypted_token = user['jira_api_token']
-                return self.fernet.decrypt(encrypted_token)
-            else:
-                return None
-        raise RuntimeError("User with email {} not found".format(email))
+        return self._get_api_token(email, 'jira_api_token')
 
     def store_toggl_api_token(self, email, api_token):
         encrypted_token = self.fernet.encrypt(api_token.encode('UTF-8'))
-        return self.db.users.update({'email': email}, {'$set': {'toggl_api_token': encrypted_token}})
+        result = self.db.users.update({'email': email}, {'$set': {'toggl_api_token': encrypted_token}})
+        self._purge_api_token(email, 'toggl_api_token')
+        return result
 
     def get_toggl_api_token(self, email):
-        user = self.get_user(email)
-        if user:
-            if 'toggl_api_token' in user:
-                encrypted_token = user['toggl_api_token']
-                return self.fernet.decrypt(encrypted_token)
-            else:
-                return None
-        raise RuntimeError("User with email {} not found".format(email))
+        return self._get_api_token(email, 'toggl_api_token')
+
+    def _get_api_token(self, email, field):
+        key = (email, field)
+        with self.token_cache_lock:
+            entry = self.token_cache.get(key)
+            if entry and time.time() - entry[0] < self.TOKEN_CACHE_TTL:
+                self.token_cache.move_to_end(key)
+                return entry[1]
+
+        user = self.db.users.find_one({'email': email}, {field: 1})
+        if not user:
+            raise RuntimeError("User with email {} not found".format(email))
+        if field not in user:
+            # Not cached, the user is about to register the token (possibly through another worker)
+            return None
+        token = self.fernet.decrypt(user[field])
+
+        with self.token_cache_lock:
+            self.token_cache[key] = (time.time(), token)
+            self.token_cache.move_to_end(key)
+            while len(self.token_cache) > self.TOKEN_CACHE_SIZE:
+                self.token_cache.popitem(last=False)
+        return token
+
+    def _purge_api_token(self, email, field):
+        with self.token_cache_lock:
+            self.token_cache.pop((email, field), None)
 
     def _fill_db_with_test_data(self):
         self._drop_db()
@@ -187,12 +406,17 @@ class DatabaseManager:
         self.db.rewards.insert_many(
             [reward_category_project, reward_category_diligence, reward_category_branding,
              reward_category_company, reward_category_misc])
+        self._invalidate_catalog('rewards')
 
         team_oriflame = {'id': 1, 'name': 'Oriflame'}
         team_fiddo = {'id': 2, 'name': 'Fiddo'}
         self.db.teams.insert_many([team_oriflame, team_fiddo])
+        self._invalidate_catalog('teams')
 
     def _drop_db(self):
+        for name in self.CATALOGS:
+            self._invalidate_catalog(name)
+        self._bump_version('requests')
         self.db.teams.remove()
         print(list(self.get_teams()))
         self.db.users.remove()
@@ -210,64 +434,327 @@ class DatabaseManager:
         self.store_record({'change_by': changed_by, 'user': user_email, 'reason': reason, 'points': points})
         self.update_points(user_email, points)
 
+    def assign_points_bulk(self, user_emails, points, reason, changed_by):
+        records = [{'change_by': changed_by, 'user': user_email, 'reason': reason, 'points': points}
+                   for user_email in user_emails]
+        updates = [UpdateOne({'email': user_email}, {'$inc': {'points': points}}) for user_email in user_emails]
+        with self._transaction() as session:
+            self.store_records(records, session=session)
+            self.db.users.bulk_write(updates, ordered=False, session=session)
+        changes = {}
+        for user_email in user_emails:
+            changes[user_email] = changes.get(user_email, 0) + points
+        points_changed.send(self, changes=changes)
+
+    def _supports_transactions(self):
+        # Transactions need a replica set (Atlas is one) or mongos, a standalone mongod gets plain writes.
+        # Unlike client.primary, the command waits for the server discovery.
+        hello = self.client.admin.command('ismaster')
+        return 'setName' in hello or hello.get('msg') == 'isdbgrid'
+
+    @contextmanager
+    def _transaction(self):
+        if not self.supports_transactions:
+            yield None
+            return
+        with self.client.start_session() as session:
+            with session.start_transaction():
+                yield session
+
     def update_points(self, user_email, points):
         self.db.users.update({'email': user_email}, {'$inc': {'points': points}})
-
-    def store_record(self, record):
-        return self.db.records.insert_one(record)
+        points_changed.send(self, changes={user_email: points})
+
+    def store_record(self, record, session=None):
+        result = self.db.records.insert_one(record, session=session)
+        self._update_points_buckets([record], session)
+        return result
+
+    def store_records(self, records, session=None):
+        result = self.db.records.insert_many(records, session=session)
+        self._update_points_buckets(records, session)
+        return result
+
+    def _update_points_buckets(self, records, session=None):
+        # Only awarded points count into the periods, not prizes, refunds or opening balances
+        updates = []
+        for record in records:
+            if record.get('request_id') or not record.get('change_by'):
+                continue
+            for period in self.get_periods(record['_id'].generation_time):
+                updates.append(UpdateOne({'period': period, 'user': record['user']},
+                                         {'$inc': {'points': record['points']}}, upsert=True))
+        if updates:
+            self.db.points_buckets.bulk_write(updates, ordered=False, session=session)
+
+    def ensure_points_buckets(self):
+        # Awards made before the buckets existed are only in the ledger
+        if self.db.points_buckets.find_one({}, {'_id': 1}) is None:
+            self.rebuild_points_buckets()
+
+    def rebuild_points_buckets(self):
+        """Fills the buckets from the whole ledger, for records stored before the buckets existed."""
+        totals = defaultdict(int)
+        awards = {'request_id': {'$exists': False}, 'change_by': {'$ne': None}}
+        for record in self.db.records.find(awards, {'user': 1, 'points': 1}):
+            for period in self.get_periods(record['_id'].generation_time):
+                totals[(period, record['user'])] += record['points']
+
+        # $set rather than $inc, so workers rebuilding at the same time end up with the same totals
+        updates = [UpdateOne({'period': period, 'user': user}, {'$set': {'points': points}}, upsert=True)
+                   for (period, user), points in totals.items()]
+        for start in range(0, len(updates), self.BULK_WRITE_SIZE):
+            self.db.points_buckets.bulk_write(updates[start:start + self.BULK_WRITE_SIZE], ordered=False)
+
+    @staticmethod
+    def get_periods(moment):
+        # '2019-03' (month), '2019-Q1' (quarter) and '2019' (year)
+        return ['{}-{:02d}'.format(moment.year, moment.month),
+                '{}-Q{}'.format(moment.year, (moment.month - 1) // 3 + 1),
+                str(moment.year)]
+
+    def get_current_period(self, window):
+        month, quarter, year = self.get_periods(datetime.utcnow())
+        return {'month': month, 'quarter': quarter, 'year': year}[window]
+
+    def get_top_users(self, period, limit=10):
+        buckets = list(self.db.points_buckets.find({'period': period}, {'_id': 0, 'user': 1, 'points': 1})
+                       .sort([('points', pymongo.DESCENDING), ('user', pymongo.ASCENDING)]).limit(limit))
+        users = self.db.users.find({'email': {'$in': [bucket['user'] for bucket in buckets]}},
+                                   {'_id': 0, 'email': 1, 'fullname': 1})
+        fullnames = {user['email']: user['fullname'] for user in users}
+        return [{'email': bucket['user'], 'fullname': fullnames.get(bucket['user'], bucket['user']),
+                 'points': bucket['points']} for bucket in buckets]
+
+    def ensure_opening_balances(self):
+        """Users added by hand in Mongo get the opening balance record _store_user would have written."""
+        # Users in a snapshot are covered by it, their older records don't matter
+        known = set(self.db.records.distinct('user', {'change_by': None, 'reason': self.OPENING_BALANCE_REASON}))
+        known.update(self.db.balance_snapshots.distinct('user'))
+        for user in self.db.users.find({'email': {'$nin': list(known)}}, {'email': 1, 'points': 1}):
+            # Points changed since the user was added are in the ledger already
+            opening_points = user.get('points', 0) - self.get_balance(user['email'])
+            if opening_points:
+                self.store_record({'change_by': None, 'user': user['email'], 'reason': self.OPENING_BALANCE_REASON,
+                                   'points': opening_points})
+
+    def create_balance_snapshots(self):
+        """Stores every user's balance as of a point slightly in the past, computed from the previous snapshot."""
+        if self.db.balance_snapshots.find_one({}, {'_id': 1}) is None:
+            self._seed_balance_snapshots()
+            return
+        # Records get their _id on the client, so leave a margin for writes still in flight
+        boundary = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=self.SNAPSHOT_MARGIN))
+        if self._get_snapshot_run(boundary) == boundary:
+            return
+        balances = self.get_balances(boundary)
+        snapshots = [{'run': boundary, 'user': user, 'points': points, 'created_at': datetime.utcnow()}
+                     for user, points in balances.items()]
+        if snapshots:
+            self.db.balance_snapshots.insert_many(snapshots)
+
+    def _seed_balance_snapshots(self):
+        """Takes the points counters as the first snapshot.
+
+        Records from before the ledger lack the opening balances and still contain the old grant deductions,
+        so balances are only exact from this snapshot on.
+        """
+        run = ObjectId()
+        created_at = datetime.utcnow()
+        snapshots = [{'run': run, 'user': user['email'], 'points': user.get('points', 0), 'created_at': created_at}
+                     for user in self.db.users.find({}, {'email': 1, 'points': 1})]
+        if snapshots:
+            self.db.balance_snapshots.insert_many(snapshots)
+
+    def get_balances(self, at=None):
+        """Balances of all users recomputed from the ledger, at is a datetime or an ObjectId boundary."""
+        boundary = self._to_boundary(at)
+        run = self._get_snapshot_run(boundary)
+        balances = {}
+        record_query = {'_id': {'$lte': boundary}}
+        if run is not None:
+            for snapshot in self.db.balance_snapshots.find({'run': run}, {'user': 1, 'points': 1}):
+                balances[snapshot['user']] = snapshot['points']
+            record_query['_id']['$gt'] = run
+
+        # Only the tail of the ledger after the last snapshot is summed
+        pipeline = [{'$match': record_query}, {'$group': {'_id': '$user', 'points': {'$sum': '$points'}}}]
+        for tail in self.db.records.aggregate(pipeline):
+            balances[tail['_id']] = balances.get(tail['_id'], 0) + tail['points']
+        return balances
+
+    def get_balance(self, email, at=None):
+        boundary = self._to_boundary(at)
+        run = self._get_snapshot_run(boundary)
+        balance = 0
+        record_query = {'user': email, '_id': {'$lte': boundary}}
+        if run is not None:
+            snapshot = self.db.balance_snapshots.find_one({'run': run, 'user': email}, {'points': 1})
+            if snapshot:
+                balance = snapshot['points']
+            record_query['_id']['$gt'] = run
+
+        pipeline = [{'$match': record_query}, {'$group': {'_id': None, 'points': {'$sum': '$points'}}}]
+        for tail in self.db.records.aggregate(pipeline):
+            balance += tail['points']
+        return balance
+
+    def get_leaderboard_at(self, at):
+        balances = self.get_balances(at)
+        return sorted(balances.items(), key=lambda balance: (-balance[1], balance[0]))
+
+    def reconcile_points(self):
+        """Returns {email: (points counter, ledger balance)} for the users whose counter drifted from the ledger."""
+        balances = self.get_balances()
+        drift = {}
+        for user in self.db.users.find({}, {'email': 1, 'points': 1}):
+            ledger_points = balances.get(user['email'], 0)
+            if user.get('points', 0) != ledger_points:
+                drift[user['email']] = (user.get('points', 0), ledger_points)
+        return drift
+
+    def _get_snapshot_run(self, boundary):
+        snapshot = self.db.balance_snapshots.find_one({'run': {'$lte': boundary}}, {'run': 1},
+                                                      sort=[('run', pymongo.DESCENDING)])
+        return snapshot['run'] if snapshot else None
+
+    @staticmethod
+    def _to_boundary(at):
+        if at is None:
+            at = datetime.utcnow()
+        if isinstance(at, datetime):
+            # The largest possible ObjectId of that second, so records created during it are included
+            return ObjectId(ObjectId.from_datetime(at).binary[:4] + b'\xff' * 8)
+        return at
 
     def get_prize(self, prize_id):
-        query = {'id': int(prize_id)}
-        return self.db.prizes.find_one(query)
+        prize_id = int(prize_id)
+        for prize in self._get_catalog('prizes'):
+            if prize['id'] == prize_id:
+                return prize
+        return None
 
-    def store_request(self, email, prize_id):
-        prize = self.get_prize(prize_id)
-        self.update_points(email, -int(prize['price']))
-        request = {'email': email, 'prize_id': prize_id, 'granted': False}
-        return self.db.requests.insert_one(request)
+    def redeem_prize(self, email, prize_id, client_token=None):
+        """Atomically takes the price from the user's points and stores the request.
 
-    def get_ungranted_requests(self):
+        Returns False when this prize was already requested with the same client_token (a double submit).
+        """
+        prize = self.get_prize(prize_id)
+        price = int(prize['price'])
+        request = {'_id': ObjectId(), 'email': email, 'prize_id': prize_id, 'granted': False}
+        if client_token:
+            # One form may request several prizes (another tab, the Back button), only repeats of a prize are dropped
+            request['client_token'] = '{}:{}'.format(client_token, prize['id'])
+            if self.db.requests.find_one({'client_token': request['client_token']}, {'_id': 1}):
+                return False
+
+        try:
+            with self._transaction() as session:
+                # The filter makes the balance check and the decrement a single atomic operation
+                user = self.db.users.find_one_and_update({'email': email, 'points': {'$gte': price}},
+                                                         {'$inc': {'points': -price}},
+                                                         projection={'points': 1},
+                                                         return_document=ReturnDocument.AFTER, session=session)
+                if user is None:
+                    raise NotEnoughPointsException('Sorry, it appears you do not have enough points for this prize.')
+                try:
+                    self.db.requests.insert_one(request, session=session)
+                except DuplicateKeyError:
+                    if session is None:
+                        # No transaction to roll back the decrement
+                        self.db.users.update_one({'email': email}, {'$inc': {'points': price}})
+                    raise
+                self.store_record({'change_by': email, 'user': email, 'request_id': request['_id'],
+                                   'reason': 'Prize request', 'points': -price}, session=session)
+        except DuplicateKeyError:
+            # Lost the race with the same submit
+            return False
+        self._bump_version('requests')
+        points_changed.send(self, changes={email: -price})
+        return True
+
+    def get_ungranted_requests(self, projection=None, limit=0, after=None):
         query = {'granted': False}
-        return self.db.requests.find(query)
+        return self._find_requests(query, projection, limit, after)
 
-    def get_requests(self, email):
+    def get_requests(self, email, projection=None, limit=0, after=None):
         query = {'email': email}
-        return self.db.requests.find(query)
+        return self._find_requests(query, projection, limit, after)
+
+    def _find_requests(self, query, projection, limit, after):
+        # Requests are paged by their _id, after is the _id of the last request of the previous page
+        if after:
+            if not ObjectId.is_valid(after):
+                raise ValueError('Invalid page key {}'.format(after))
+            query['_id'] = {'$gt': ObjectId(after)}
+        return self.db.requests.find(query, projection).sort('_id', pymongo.ASCENDING).limit(limit)
+
+    def get_requests_with_prizes(self, email, limit=0, after=None):
+        return self._join_prizes(self.get_requests(email, self.REQUEST_LIST_FIELDS, limit, after))
+
+    def get_ungranted_requests_with_prizes(self, limit=0, after=None):
+        return self._join_prizes(self.get_ungranted_requests(self.REQUEST_LIST_FIELDS, limit, after))
+
+    def _join_prizes(self, requests):
+        # prize_id is stored as it came in the URL (a string), so the join is done here against the
+        # in-memory prize catalog and not with $lookup
+        requests = list(requests)
+        prizes = {prize['id']: prize for prize in self._get_catalog('prizes')}
+        for request in requests:
+            prize = prizes[int(request['prize_id'])]
+            request['description'] = prize['description']
+            request['price'] = prize['price']
+        return requests
 
     def cancel_request(self, request_id):
         request = self.get_request(request_id)
-        prize = self.get_prize(request['prize_id'])
-        self.update_points(request['email'], int(prize['price']))
-        query = {'_id': ObjectId(request_id)}
-        return self.db.requests.delete_one(query)
+        price = int(self.get_prize(request['prize_id'])['price'])
+        with self._transaction() as session:
+            result = self.db.requests.delete_one({'_id': request['_id']}, session=session)
+            if result.deleted_count:
+                # The refund goes through the ledger like any other change
+                self.store_record({'change_by': request['email'], 'user': request['email'],
+                                   'request_id': request['_id'], 'reason': 'Prize request cancelled',
+                                   'points': price}, session=session)
+                self.db.users.update_one({'email': request['email']}, {'$inc': {'points': price}}, session=session)
+        if result.deleted_count:
+            self._bump_version('requests')
+            points_changed.send(self, changes={request['email']: price})
+        return result
 
     def store_rewards_category(self, category):
-        return self.db.rewards.insert_one(category)
+        result = self.db.rewards.insert_one(category)
+        self._invalidate_catalog('rewards')
+        return result
 
     def get_all_rewards(self):
-        return self.db.rewards.find()
+        return list(self._get_catalog('rewards'))
 
     def grant_request(self, request_id, granted_by):
-        request = self.get_request(request_id)
-        prize = self.get_prize(request['prize_id'])
-        self.store_record(
-            {'change_by': granted_by, 'user': request['email'], 'request_id': request['_id'],
-             'points': -int(prize['price'])})
-        return self.db.requests.update({'_id': request['_id']}, {'$set': {'granted': True}})
+        # The points were already taken (and recorded) when the prize was requested
+        result = self.db.requests.update({'_id': ObjectId(request_id)},
+                                         {'$set': {'granted': True, 'granted_by': granted_by}})
+        self._bump_version('requests')
+        return result
 
     def get_request(self, request_id):
         query = {'_id': ObjectId(request_id)}
         return self.db.requests.find_one(query)
 
-    def query_users(self, name, team_id=-1):
+    def query_users(self, name, team_id=-1, projection=None):
         if not name:
             name = ''
 
-        if team_id == -1:
-            query = {'email': {'$regex': name}}
-        else:
-            query = {'email': {'$regex': name}, 'team': team_id}
-        return self.db.users.find(query)
+        # Every word has to be a prefix of one of the user's tokens, anchored regexes can use the index
+        query = {}
+        prefixes = normalize_search_text(name).split()
+        if prefixes:
+            # Admins register users directly in Mongo, make those searchable without a restart
+            self.ensure_search_tokens()
+            query['$and'] = [{'search_tokens': {'$regex': '^' + re.escape(prefix)}} for prefix in prefixes]
+        if team_id != -1:
+            query['team'] = team_id
+        return self.db.users.find(query, projection)
 
     def get_teams(self):
-        return self.db.teams.find()
+        return list(self._get_catalog('teams'))
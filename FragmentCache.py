@@ -0,0 +1,35 @@
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """Rendered template fragments keyed by a hash of their inputs, shared by all users.
+
+    Used from templates as::
+
+        {% call cached_fragment('task', task, is_current) %} ... {% endcall %}
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.fragments = OrderedDict()
+        self.lock = Lock()
+
+    def render(self, *parts, caller):
+        key = hashlib.md5(repr(parts).encode('UTF-8')).hexdigest()
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+                return fragment
+
+        # The block is rendered only on a miss
+        fragment = Markup(caller())
+        with self.lock:
+            self.fragments[key] = fragment
+            while len(self.fragments) > self.max_entries:
+                self.fragments.popitem(last=False)
+        return fragment
@@ -0,0 +1,161 @@
+import bisect
+import functools
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+
+
+class Metrics:
+    """Per-route latency histograms and outbound call counters, exported in the Prometheus text format."""
+    # seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_buckets = defaultdict(lambda: [0] * (len(self.BUCKETS) + 1))
+        self.request_sums = defaultdict(float)
+        self.call_counts = defaultdict(int)
+        self.call_sums = defaultdict(float)
+
+    def observe_request(self, route, duration):
+        with self.lock:
+            self.request_buckets[route][bisect.bisect_left(self.BUCKETS, duration)] += 1
+            self.request_sums[route] += duration
+
+    def observe_call(self, category, name, duration):
+        with self.lock:
+            self.call_counts[(category, name)] += 1
+            self.call_sums[(category, name)] += duration
+
+    def render(self):
+        lines = ['# TYPE http_request_duration_seconds histogram']
+        with self.lock:
+            for route, buckets in sorted(self.request_buckets.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append('http_request_duration_seconds_bucket{{route="{}",le="{}"}} {}'
+                                 .format(route, bound, cumulative))
+                lines.append('http_request_duration_seconds_sum{{route="{}"}} {}'
+                             .format(route, self.request_sums[route]))
+                lines.append('http_request_duration_seconds_count{{route="{}"}} {}'.format(route, cumulative))
+
+            lines.append('# TYPE outbound_calls_total counter')
+            for (category, name), count in sorted(self.call_counts.items()):
+                lines.append('outbound_calls_total{{category="{}",name="{}"}} {}'.format(category, name, count))
+            lines.append('# TYPE outbound_call_duration_seconds_total counter')
+            for (category, name), duration in sorted(self.call_sums.items()):
+                lines.append('outbound_call_duration_seconds_total{{category="{}",name="{}"}} {}'
+                             .format(category, name, duration))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+_active = threading.local()
+
+
+def _record_span(category, name, duration):
+    metrics.observe_call(category, name, duration)
+    spans = getattr(_active, 'spans', None)
+    if spans is None and has_request_context():
+        spans = g.setdefault('spans', [])
+    if spans is not None:
+        spans.append((category, name, duration))
+
+
+def bind_spans(f):
+    """Makes the spans of f, when run on another thread, count into the current request.
+
+    Works on threads that are bound themselves, so pools started from a pool task are covered too.
+    """
+    spans = getattr(_active, 'spans', None)
+    if spans is None:
+        if not has_request_context():
+            return f
+        spans = g.setdefault('spans', [])
+
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        previous = getattr(_active, 'spans', None)
+        _active.spans = spans
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _active.spans = previous
+
+    return decorated_function
+
+
+def instrument(category, name):
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            # Only the outermost call of a category is timed, so nested calls aren't counted twice
+            depth = getattr(_active, category, 0)
+            setattr(_active, category, depth + 1)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                setattr(_active, category, depth)
+                if depth == 0:
+                    _record_span(category, name, time.perf_counter() - start)
+
+        return decorated_function
+
+    return decorator
+
+
+def instrument_methods(target, category, names=None):
+    """Wraps the given methods (all public ones by default) of a class or an object in spans."""
+    if names is None:
+        names = [name for name, value in vars(target).items()
+                 if callable(value) and not isinstance(value, (staticmethod, classmethod))
+                 and not name.startswith('_')]
+    for name in names:
+        setattr(target, name, instrument(category, name)(getattr(target, name)))
+
+
+def init_app(app):
+    """Adds the Server-Timing header, the slow request log and the render_template spans."""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started_at = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        if 'request_started_at' not in g:
+            return response
+        duration = time.perf_counter() - g.request_started_at
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(route, duration)
+
+        totals = defaultdict(lambda: [0.0, 0])
+        for category, _, span_duration in g.get('spans', []):
+            totals[category][0] += span_duration
+            totals[category][1] += 1
+        timings = ['{};dur={:.1f};desc="{} calls"'.format(category, total * 1000, count)
+                   for category, (total, count) in sorted(totals.items())]
+        timings.append('total;dur={:.1f}'.format(duration * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+        if duration * 1000 > app.config['SLOW_REQUEST_THRESHOLD']:
+            spans = ', '.join('{}.{} {:.1f}ms'.format(category, name, span_duration * 1000)
+                              for category, name, span_duration in g.get('spans', []))
+            app.logger.warning('Slow request %s %s took %.1fms: %s', request.method, request.path,
+                               duration * 1000, spans)
+        return response
+
+    def start_render(sender, template, context, **extra):
+        g.setdefault('render_started_at', []).append(time.perf_counter())
+
+    def finish_render(sender, template, context, **extra):
+        started = g.get('render_started_at')
+        if started:
+            _record_span('template', template.name, time.perf_counter() - started.pop())
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(finish_render, app, weak=False)
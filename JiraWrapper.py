@@ -1,7 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from jira import JIRA
 
+from Instrumentation import bind_spans
+
 
 class JiraWrapper(JIRA):
+    SEARCH_BLOCK_SIZE = 100
+    SEARCH_WORKERS = 4
+    TRANSITION_WORKERS = 8
+    TASK_FIELDS = 'summary,status,description,updated'
 
     def __init__(self, server, basic_auth):
         super().__init__(server=server, basic_auth=basic_auth)
@@ -9,20 +17,47 @@ class JiraWrapper(JIRA):
     def get_tasks_with_transitions(self):
         jira_current_user = self.current_user()
         jql = 'assignee={} AND status not in (resolved, closed) AND createdDate >= -365d'.format(jira_current_user)
-        block_size = 100
-        block_num = 0
-        jira_tasks = []
-        while True:
-            start_idx = block_num * block_size
-            issues = self.search_issues(jql, start_idx, block_size)
-            if len(issues) == 0:
-                # Retrieve issues until there are no more to come
-                break
-            block_num += 1
-            jira_tasks.extend(issues)
+        jira_tasks = self._search_all_issues(jql)
+        self._fill_transitions(jira_tasks)
+        return jira_tasks
 
-        for jira_task in jira_tasks:
-            transitions = self.transitions(jira_task.key)
-            jira_task.transitions = transitions
+    def _search_all_issues(self, jql):
+        first_page = self._search_page(jql, 0)
+        jira_tasks = list(first_page)
+        page_size = len(jira_tasks)
+        if page_size == 0 or page_size >= first_page.total:
+            return jira_tasks
 
+        # The first response tells us how many issues there are, so the rest can be fetched at once.
+        # Jira may cap the page below SEARCH_BLOCK_SIZE, so step by what it actually returned.
+        start_indices = range(page_size, first_page.total, page_size)
+        workers = min(self.SEARCH_WORKERS, len(start_indices))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Count the calls made on the pool into the spans of the caller
+            search_page = bind_spans(lambda start_idx: self._search_page(jql, start_idx))
+            for issues in executor.map(search_page, start_indices):
+                jira_tasks.extend(issues)
         return jira_tasks
+
+    def _search_page(self, jql, start_idx):
+        # Ask Jira to embed the available transitions and return only the fields tasks.html renders
+        return self.search_issues(jql, start_idx, self.SEARCH_BLOCK_SIZE, fields=self.TASK_FIELDS,
+                                  expand='transitions')
+
+    def _fill_transitions(self, jira_tasks):
+        missing = []
+        for jira_task in jira_tasks:
+            if 'transitions' in jira_task.raw:
+                jira_task.transitions = jira_task.raw['transitions']
+            else:
+                missing.append(jira_task)
+
+        if not missing:
+            return
+
+        # Fall back to fetching the transitions one by one, but on a bounded pool
+        workers = min(self.TRANSITION_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(bind_spans(lambda task: self.transitions(task.key)), missing)
+            for jira_task, transitions in zip(missing, results):
+                jira_task.transitions = transitions
@@ -0,0 +1,130 @@
+import threading
+from datetime import datetime, timedelta
+
+import pymongo
+import requests
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError, DuplicateKeyError
+
+
+class JobQueue:
+    """Jobs stored in a Mongo collection and run by a background thread, so requests only have to enqueue them."""
+    # seconds
+    POLL_INTERVAL = 5
+    RETRY_BACKOFF = 30
+    # a job running longer than this is considered abandoned by a dead worker and is picked up again
+    LOCK_TIMEOUT = 300
+    MAX_ATTEMPTS = 5
+    BATCH_SIZE = 10
+    # finished jobs are removed by Mongo after these, failed ones are kept longer to look into them
+    DONE_JOB_TTL = 7 * 24 * 3600
+    FAILED_JOB_TTL = 30 * 24 * 3600
+
+    def __init__(self, collection, handlers):
+        """handlers maps a job type to a callable(http_session, payload), raising an exception on failure."""
+        self.collection = collection
+        self.collection.create_index([('status', pymongo.ASCENDING), ('run_at', pymongo.ASCENDING)])
+        # Only finished jobs get expires_at, the recurring ones are rescheduled and never expire
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+        self.handlers = handlers
+        self.intervals = {}
+        self.http_session = requests.Session()
+        self.wakeup = threading.Event()
+
+    def enqueue(self, job_type, payload, delay=0):
+        now = datetime.utcnow()
+        self.collection.insert_one({'type': job_type, 'payload': payload, 'status': 'pending', 'attempts': 0,
+                                    'run_at': now + timedelta(seconds=delay), 'created_at': now})
+        self.wakeup.set()
+
+    def schedule(self, job_type, interval):
+        """Runs the job every interval seconds, shared by all the workers calling this.
+
+        A recurring job is a single document with a fixed _id, which is rescheduled after every run.
+        """
+        self.intervals[job_type] = interval
+        now = datetime.utcnow()
+        try:
+            self.collection.update_one({'_id': self._recurring_id(job_type)},
+                                       {'$setOnInsert': {'type': job_type, 'payload': {}, 'status': 'pending',
+                                                         'attempts': 0, 'run_at': now, 'created_at': now}},
+                                       upsert=True)
+        except DuplicateKeyError:
+            # Another worker inserted it at the same time
+            pass
+
+    @staticmethod
+    def _recurring_id(job_type):
+        return 'recurring-{}'.format(job_type)
+
+    def start(self):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def drain(self):
+        """Runs up to BATCH_SIZE due jobs and returns how many were run."""
+        jobs = []
+        while len(jobs) < self.BATCH_SIZE:
+            job = self._claim()
+            if job is None:
+                break
+            jobs.append(job)
+
+        # The jobs of one batch share the keep-alive connections of http_session
+        for job in jobs:
+            try:
+                self.handlers[job['type']](self.http_session, job['payload'])
+            except Exception as e:
+                self._retry(job, e)
+            else:
+                if job['_id'] == self._recurring_id(job['type']):
+                    self._reschedule(job)
+                else:
+                    now = datetime.utcnow()
+                    self.collection.update_one({'_id': job['_id']},
+                                               {'$set': {'status': 'done', 'finished_at': now,
+                                                         'expires_at': now + timedelta(seconds=self.DONE_JOB_TTL)}})
+        return len(jobs)
+
+    def _reschedule(self, job, error=None):
+        interval = self.intervals.get(job['type'], self.RETRY_BACKOFF)
+        now = datetime.utcnow()
+        self.collection.update_one({'_id': job['_id']},
+                                   {'$set': {'status': 'pending', 'attempts': 0, 'finished_at': now,
+                                             'run_at': now + timedelta(seconds=interval), 'error': error}})
+
+    def _claim(self):
+        now = datetime.utcnow()
+        query = {'$or': [{'status': 'pending', 'run_at': {'$lte': now}},
+                         {'status': 'running', 'locked_at': {'$lte': now - timedelta(seconds=self.LOCK_TIMEOUT)}}]}
+        return self.collection.find_one_and_update(query,
+                                                   {'$set': {'status': 'running', 'locked_at': now},
+                                                    '$inc': {'attempts': 1}},
+                                                   sort=[('run_at', pymongo.ASCENDING)],
+                                                   return_document=ReturnDocument.AFTER)
+
+    def _retry(self, job, error):
+        if job['attempts'] >= self.MAX_ATTEMPTS and job['_id'] == self._recurring_id(job['type']):
+            # A recurring job must not stop for good, try again at its next run
+            self._reschedule(job, str(error))
+            return
+        if job['attempts'] >= self.MAX_ATTEMPTS:
+            now = datetime.utcnow()
+            update = {'status': 'failed', 'error': str(error), 'finished_at': now,
+                      'expires_at': now + timedelta(seconds=self.FAILED_JOB_TTL)}
+        else:
+            delay = self.RETRY_BACKOFF * 2 ** (job['attempts'] - 1)
+            update = {'status': 'pending', 'error': str(error),
+                      'run_at': datetime.utcnow() + timedelta(seconds=delay)}
+        self.collection.update_one({'_id': job['_id']}, {'$set': update})
+
+    def _run(self):
+        while True:
+            try:
+                if self.drain() == self.BATCH_SIZE:
+                    # There may be more jobs waiting
+                    continue
+            except PyMongoError:
+                pass
+            self.wakeup.wait(self.POLL_INTERVAL)
+            self.wakeup.clear()
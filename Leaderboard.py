@@ -0,0 +1,172 @@
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime
+
+from flask import render_template
+
+from DatabaseManager import points_changed
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    """Users ranked by points, kept in memory and rendered once per change instead of once per page view."""
+    POLL_INTERVAL = 10
+    # seconds, changes made within this interval are pushed to the screens as one event
+    COALESCE_INTERVAL = 1
+    HEARTBEAT_INTERVAL = 15
+    FIELDS = {'_id': 0, 'email': 1, 'fullname': 1, 'points': 1}
+
+    def __init__(self, database_manager):
+        self.database_manager = database_manager
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.users = None
+        self.users_by_email = {}
+        self.version = None
+        self.updated_at = None
+        self.fragment = None
+        self.fragment_version = None
+        points_changed.connect(self._on_points_changed, weak=False)
+
+    def start(self):
+        thread = threading.Thread(target=self._watch, daemon=True)
+        thread.start()
+
+    def get_ranked_users(self):
+        with self.lock:
+            if self.users is None:
+                self._load()
+            return [dict(user) for user in self.users], self.version
+
+    def get_fragment(self):
+        """Returns the rendered leaderboard and its version, needs an application context."""
+        users, version = self.get_ranked_users()
+        if self.fragment_version != version:
+            self.fragment = render_template('fragments/leaderboard.html', users=users)
+            self.fragment_version = version
+        return self.fragment, version
+
+    def get_version(self):
+        """Returns the version and the time of the last change."""
+        with self.lock:
+            if self.users is None:
+                self._load()
+            return self.version, self.updated_at
+
+    def iter_changes(self, version, duration):
+        """Yields (event, version, rows) until duration runs out.
+
+        'reset' means the client is out of sync and has to reload the whole leaderboard, 'deltas' carries
+        only the rows whose rank or points changed and 'ping' keeps the connection open.
+        """
+        deadline = time.time() + duration
+        users, current_version = self.get_ranked_users()
+        if current_version != version:
+            yield 'reset', current_version, None
+        version = current_version
+        previous = self._ranks(users)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            with self.changed:
+                changed = self.changed.wait_for(lambda: self.version != version,
+                                                min(remaining, self.HEARTBEAT_INTERVAL))
+            if not changed:
+                yield 'ping', version, None
+                continue
+
+            # Let a burst of changes (e.g. points for a whole team) settle into a single event
+            time.sleep(self.COALESCE_INTERVAL)
+            users, version = self.get_ranked_users()
+            ranks = self._ranks(users)
+            if ranks.keys() != previous.keys():
+                yield 'reset', version, None
+            else:
+                yield 'deltas', version, [row for email, row in ranks.items() if previous[email] != row]
+            previous = ranks
+
+    @staticmethod
+    def _ranks(users):
+        return {user['email']: {'email': user['email'], 'fullname': user['fullname'], 'points': user['points'],
+                                'rank': rank}
+                for rank, user in enumerate(users, 1)}
+
+    def _load(self):
+        users = list(self.database_manager.db.users.find({}, self.FIELDS).sort('points', -1))
+        for user in users:
+            # Users are registered by hand in Mongo, don't let an incomplete document break the ranking
+            self._fill_defaults(user)
+        self.users_by_email = {user['email']: user for user in users}
+        self.users = users
+        self._sort()
+
+    def _sort(self):
+        # The list is almost sorted after a single change, so this is close to linear
+        self.users.sort(key=lambda user: (-user['points'], user['email']))
+        # Derived from the content, so every gunicorn worker ends up with the same version (and ETag)
+        ranking = [(user['email'], user['fullname'], user['points']) for user in self.users]
+        version = hashlib.md5(repr(ranking).encode('UTF-8')).hexdigest()
+        if version != self.version:
+            self.version = version
+            self.updated_at = datetime.utcnow()
+            self.changed.notify_all()
+
+    @staticmethod
+    def _fill_defaults(user):
+        user.setdefault('points', 0)
+        user.setdefault('fullname', user['email'])
+        return user
+
+    def _on_points_changed(self, sender, changes):
+        if self.users is None:
+            return
+        # Re-read the absolute points instead of adding the deltas, the change stream may have applied them already
+        users = self.database_manager.db.users.find({'email': {'$in': list(changes)}}, self.FIELDS)
+        self._set_points({user['email']: self._fill_defaults(user)['points'] for user in users})
+
+    def _set_points(self, points_by_email):
+        with self.lock:
+            if self.users is None:
+                return
+            changed = False
+            for email, points in points_by_email.items():
+                user = self.users_by_email.get(email)
+                if user is None:
+                    self._load()
+                    return
+                if user['points'] != points:
+                    user['points'] = points
+                    changed = True
+            if changed:
+                self._sort()
+
+    def _watch(self):
+        # Changes made by other gunicorn workers come through the change stream,
+        # a standalone mongod doesn't have one, so fall back to polling
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+        try:
+            with self.database_manager.db.users.watch(pipeline, full_document='updateLookup') as stream:
+                for change in stream:
+                    document = change.get('fullDocument')
+                    if change['operationType'] == 'update' and document:
+                        self._set_points({document['email']: self._fill_defaults(document)['points']})
+                    else:
+                        with self.lock:
+                            self._load()
+        except Exception:
+            # Whatever stopped the stream, a dead thread would freeze the overview
+            logger.exception('Leaderboard change stream failed, polling instead')
+            self._poll()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            try:
+                with self.lock:
+                    self._load()
+            except Exception:
+                logger.exception('Leaderboard reload failed')
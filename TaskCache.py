@@ -0,0 +1,89 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+
+
+def task_to_dict(jira_task):
+    # Keep only what tasks.html renders, so the entry can be stored outside of the process as well
+    return {
+        'key': jira_task.key,
+        'fields': {
+            'summary': jira_task.fields.summary,
+            'status': str(jira_task.fields.status),
+            'description': jira_task.fields.description,
+            'updated': jira_task.fields.updated,
+        },
+        'transitions': [{'id': transition['id'], 'name': transition['name']}
+                        for transition in getattr(jira_task, 'transitions', [])],
+    }
+
+
+class LruTaskCacheBackend:
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, tasks, stored_at):
+        with self.lock:
+            self.entries[key] = (stored_at, tasks)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class MongoTaskCacheBackend:
+    """Shares the cache between gunicorn workers. Expired entries are removed by a TTL index."""
+
+    def __init__(self, collection, ttl):
+        self.collection = collection
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+        self.ttl = ttl
+
+    def get(self, key):
+        entry = self.collection.find_one({'_id': key})
+        if entry is None:
+            return None
+        return entry['stored_at'], entry['tasks']
+
+    def set(self, key, tasks, stored_at):
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        self.collection.replace_one({'_id': key},
+                                    {'_id': key, 'stored_at': stored_at, 'expires_at': expires_at, 'tasks': tasks},
+                                    upsert=True)
+
+    def delete(self, key):
+        self.collection.delete_one({'_id': key})
+
+
+class TaskCache:
+
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get_tasks(self, email, loader):
+        entry = self.backend.get(email)
+        if entry is not None:
+            stored_at, tasks = entry
+            if time.time() - stored_at < self.ttl:
+                return tasks
+        tasks = [task_to_dict(jira_task) for jira_task in loader()]
+        self.backend.set(email, tasks, time.time())
+        return tasks
+
+    def invalidate(self, email):
+        self.backend.delete(email)
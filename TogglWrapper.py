@@ -1,4 +1,7 @@
 import json
+import time
+from collections import OrderedDict
+from threading import Lock
 
 import requests
 from toggl.api_client import TogglClientApi
@@ -9,17 +12,108 @@ class ProjectNotFoundException(Exception):
         self.message = message
 
 
+class TogglIndex:
+    """Projects and tasks visible to one toggl user, so timer clicks don't have to list them again."""
+    TTL = 600
+
+    def __init__(self):
+        self.lock = Lock()
+        self.projects = None
+        self.projects_loaded_at = 0
+        self.project_ids = {}
+        self.project_tasks = {}
+
+    def get_project_id(self, keyword, load_projects):
+        with self.lock:
+            loaded = False
+            if self.projects is None or self._projects_expired():
+                self._set_projects(load_projects())
+                loaded = True
+            if keyword in self.project_ids:
+                return self.project_ids[keyword]
+            project_id = self._find_project_id(keyword)
+            if project_id is None and not loaded:
+                # The project may have been created since the list was loaded
+                self._set_projects(load_projects())
+                project_id = self._find_project_id(keyword)
+            if project_id is not None:
+                # A miss isn't remembered, so a project created later is looked up again
+                self.project_ids[keyword] = project_id
+            return project_id
+
+    def get_task(self, project_id, matches, load_tasks):
+        with self.lock:
+            loaded = False
+            loaded_at, tasks = self.project_tasks.get(project_id, (0, None))
+            if tasks is None or time.time() - loaded_at > self.TTL:
+                tasks = self._set_tasks(project_id, load_tasks(project_id))
+                loaded = True
+            task = next((task for task in tasks if matches(task)), None)
+            if task is None and not loaded:
+                # Refresh only this project's tasks, a new task may have been added
+                tasks = self._set_tasks(project_id, load_tasks(project_id))
+                task = next((task for task in tasks if matches(task)), None)
+            return task
+
+    def _projects_expired(self):
+        return time.time() - self.projects_loaded_at > self.TTL
+
+    def _set_projects(self, projects):
+        self.projects = projects
+        self.projects_loaded_at = time.time()
+        self.project_ids = {}
+
+    def _find_project_id(self, keyword):
+        for project in self.projects:
+            if keyword in project['name']:
+                return project['id']
+        return None
+
+    def _set_tasks(self, project_id, tasks):
+        tasks = tasks or []
+        self.project_tasks[project_id] = (time.time(), tasks)
+        return tasks
+
+
+_toggl_indexes = OrderedDict()
+_toggl_indexes_lock = Lock()
+MAX_TOGGL_INDEXES = 256
+
+
+def get_toggl_index(api_key, workspace_id):
+    key = (api_key, workspace_id)
+    with _toggl_indexes_lock:
+        index = _toggl_indexes.get(key)
+        if index is None:
+            index = TogglIndex()
+            _toggl_indexes[key] = index
+            while len(_toggl_indexes) > MAX_TOGGL_INDEXES:
+                _toggl_indexes.popitem(last=False)
+        _toggl_indexes.move_to_end(key)
+        return index
+
+
 class TogglWrapper(TogglClientApi):
+    # seconds
+    REQUEST_TIMEOUT = 10
 
-    def __init__(self, api_key, user_agent, workspace_id=1):
+    def __init__(self, api_key, user_agent, workspace_id=1, api_base_url=None):
         settings = {
             'token': api_key,
             'user_agent': user_agent,
             'workspace_id': workspace_id
         }
         super().__init__(settings)
+        if api_base_url:
+            self.api_base_url = api_base_url
         self.toggl_auth = (api_key, 'api_token')
         self.toggl_headers = {'Content-Type': 'application/json'}
+        self.workspace_id = workspace_id
+        # One keep-alive connection pool per wrapper, wrappers are reused through ClientRegistry
+        self.session = requests.Session()
+        self.session.auth = self.toggl_auth
+        self.session.headers.update(self.toggl_headers)
+        self.index = get_toggl_index(api_key, workspace_id)
 
     def get_work_spaces(self):
         response = self.get_workspaces()
@@ -38,20 +132,19 @@ class TogglWrapper(TogglClientApi):
     def stop_time_entry(self, task_name):
         task = self.get_task_by_name(task_name)
         current_entry = self.get_current_time_entry()
-        if current_entry and task['id'] == current_entry['tid']:
+        if current_entry and task and task['id'] == current_entry.get('tid'):
             path = '/time_entries/{}/stop'.format(current_entry['id'])
             response = self._put_query(path, dict_data=None)
             return response
 
+    def close(self):
+        self.session.close()
+
     def get_projects(self):
-        return super().get_projects().json()
+        return self._get_query('/workspaces/{}/projects'.format(self.workspace_id))
 
     def get_project_id_by_keyword(self, keyword):
-        projects = self.get_projects()
-        for project in projects:
-            if keyword in project['name']:
-                return project['id']
-        return None
+        return self.index.get_project_id(keyword, self.get_projects)
 
     def get_user_data(self, with_related_data='true'):
         return self._get_query(
@@ -70,11 +163,7 @@ class TogglWrapper(TogglClientApi):
             raise ProjectNotFoundException(
                 'Project not found. Do you have the permission to view this toggl project?')
 
-        tasks = self.get_project_tasks(project_id)
-        for task in tasks:
-            if task_name in task['name']:
-                return task
-        return None
+        return self.index.get_task(project_id, lambda task: task_name in task['name'], self.get_project_tasks)
 
     def get_current_time_entry(self):
         path = '/time_entries/current'
@@ -82,11 +171,7 @@ class TogglWrapper(TogglClientApi):
         return response['data']
 
     def get_task(self, task_id, project_id):
-        tasks = self.get_project_tasks(project_id)
-        for task in tasks:
-            if task['id'] == task_id:
-                return task
-        return None
+        return self.index.get_task(project_id, lambda task: task['id'] == task_id, self.get_project_tasks)
 
     def get_task_by_id(self, task_id):
         # this call often returns empty data - problem on toggl's side
@@ -104,18 +189,17 @@ class TogglWrapper(TogglClientApi):
     def _post_query(self, path, dict_data):
         data = json.dumps(dict_data)
         url = self.api_base_url + path
-        response = requests.post(url, headers=self.toggl_headers,
-                                 auth=self.toggl_auth, data=data)
+        response = self.session.post(url, data=data, timeout=self.REQUEST_TIMEOUT)
         return response.json()
 
     def _put_query(self, path, dict_data):
         data = json.dumps(dict_data)
         url = self.api_base_url + path
-        response = requests.put(url, headers=self.toggl_headers,
-                                auth=self.toggl_auth, data=data)
+        response = self.session.put(url, data=data, timeout=self.REQUEST_TIMEOUT)
         return response.json()
 
     def _get_query(self, path, params=None):
         if params is None:
             params = {}
-        return self.query(path, params=params).json()
+        url = self.api_base_url + path
+        return self.session.get(url, params=params, timeout=self.REQUEST_TIMEOUT).json()
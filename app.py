@@ -1,30 +1,80 @@
+import hashlib
+import hmac
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from functools import wraps
 
 import requests
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, make_response
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, \
+    make_response, Response, stream_with_context, g, abort
 # from flask_bootstrap import Bootstrap
 from flask_dance.consumer import oauth_authorized
 from flask_dance.contrib.google import make_google_blueprint, google
 # from flask_scss import Scss
-from jira import JIRA
 from oauthlib.oauth2 import InvalidClientIdError, InvalidGrantError
 
-from DatabaseManager import DatabaseManager
+from ClientRegistry import ClientRegistry
+from DatabaseManager import DatabaseManager, NotEnoughPointsException
+from FragmentCache import FragmentCache
+import Instrumentation
 from JiraWrapper import JiraWrapper
+from JobQueue import JobQueue
+from Leaderboard import Leaderboard
+from TaskCache import TaskCache, LruTaskCacheBackend, MongoTaskCacheBackend
 from TogglWrapper import TogglWrapper, ProjectNotFoundException
 
 SYNETECH_WORKSPACE_ID = 689492
+# seconds, keep them below the gunicorn worker timeout
+JIRA_TIMEOUT = 25
+TOGGL_TIMEOUT = 3
+# the screens reconnect after this, so a stream doesn't hold a worker thread forever
+LEADERBOARD_STREAM_DURATION = 300
+# per worker, every open stream holds one of the gunicorn threads
+LEADERBOARD_STREAM_LIMIT = 2
+MAIL_TIMEOUT = 10
+SESSION_USER_TTL = 60
+REQUESTS_PAGE_SIZE = 50
+USERS_PAGE_SIZE = 100
+LEDGER_MAINTENANCE_INTERVAL = 24 * 60 * 60
+TOP_USERS_COUNT = 10
 
 app = Flask(__name__)
 app.config.from_object(os.environ['APP_SETTINGS'])
+
+Instrumentation.init_app(app)
+Instrumentation.instrument_methods(DatabaseManager, 'mongo')
+# Only the methods sending a request, so the calls get_tasks_with_transitions makes are counted once
+Instrumentation.instrument_methods(JiraWrapper, 'jira', ['server_info', 'current_user', 'search_issues',
+                                                         'transitions', 'add_comment', 'transition_issue'])
+Instrumentation.instrument_methods(TogglWrapper, 'toggl', ['_get_query', '_post_query', '_put_query'])
+
+fragment_cache = FragmentCache()
+app.jinja_env.globals['cached_fragment'] = fragment_cache.render
 # Bootstrap(app)
 
 # Scss(app)
 
 database_manager = DatabaseManager(app.config['MONGO_DATABASE_URI'], app.config['SECRET_KEY'],
                                    use_test_data=False)
+Instrumentation.instrument_methods(database_manager.fernet, 'fernet', ['encrypt', 'decrypt'])
+
+if app.config['TASK_CACHE_BACKEND'] == 'mongo':
+    task_cache_backend = MongoTaskCacheBackend(database_manager.db.task_cache, app.config['TASK_CACHE_TTL'])
+else:
+    task_cache_backend = LruTaskCacheBackend()
+task_cache = TaskCache(task_cache_backend, app.config['TASK_CACHE_TTL'])
+
+jira_clients = ClientRegistry(lambda basic_auth: JiraWrapper(server=app.config['JIRA_SERVER'], basic_auth=basic_auth))
+toggl_clients = ClientRegistry(lambda api_token: TogglWrapper(api_token, "SynePoints", SYNETECH_WORKSPACE_ID,
+                                                              app.config['TOGGL_API_URL']))
+aggregation_executor = ThreadPoolExecutor(max_workers=16)
+
+leaderboard = Leaderboard(database_manager)
+leaderboard.start()
+leaderboard_stream_slots = threading.BoundedSemaphore(LEADERBOARD_STREAM_LIMIT)
 
 with open('client_id.json') as file:
     client_id = json.load(file)
@@ -65,6 +115,36 @@ def login_required(f):
     return decorated_function
 
 
+def conditional(get_version):
+    """Answers 304 when neither the content version nor the user's session changed, before the view runs.
+
+    get_version returns the content version and its last modification time (or None).
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            version, last_modified = get_version()
+            # The pages also show the user's points, a menu depending on the role and flashed messages
+            key = repr((request.full_path, version, TEMPLATE_VERSION, session.get('current_user_email'),
+                        session.get('current_user_role'), session.get('current_user_points'),
+                        session.get('_flashes')))
+            etag = hashlib.md5(key.encode('UTF-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
 @oauth_authorized.connect_via(google_bp)
 def logged_in(blueprint, token):
     resp_json = google.get("/oauth2/v2/userinfo").json()
@@ -82,13 +162,30 @@ def logged_in(blueprint, token):
         redirect('/')
     else:
         session['current_user_email'] = user['email']
-        update_session()
+        update_session(user)
 
 
-def update_session():
-    user = database_manager.get_user(session['current_user_email'])
+def update_session(user=None):
+    if user is None:
+        user = database_manager.get_user(session['current_user_email'])
+    g.current_user = user
     session['current_user_role'] = user['role']
     session['current_user_points'] = user['points']
+    session['current_user_loaded_at'] = time.time()
+
+
+def get_current_user():
+    # Loaded at most once per request
+    if 'current_user' not in g:
+        update_session()
+    return g.current_user
+
+
+def get_current_user_role():
+    # The signed session keeps the role for a while, so authorized actions don't have to load the user
+    if time.time() - session.get('current_user_loaded_at', 0) > SESSION_USER_TTL:
+        get_current_user()
+    return session['current_user_role']
 
 
 @app.route('/manifest.json')
@@ -96,11 +193,43 @@ def manifest():
     return send_from_directory('static', 'manifest.json')
 
 
+def get_asset_version(paths):
+    digest = hashlib.md5()
+    for path in paths:
+        with open(os.path.join(app.root_path, path.lstrip('/')), 'rb') as asset:
+            digest.update(asset.read())
+    return digest.hexdigest()[:12]
+
+
+def get_template_paths():
+    paths = []
+    for directory, _, names in os.walk(os.path.join(app.root_path, 'templates')):
+        paths.extend(os.path.relpath(os.path.join(directory, name), app.root_path) for name in names)
+    return sorted(paths)
+
+
+PRECACHE_ASSETS = ['/static/default_style.css', '/static/fonts/Montserrat-Medium.ttf',
+                   '/static/fonts/Montserrat-SemiBold.ttf', '/static/images/logo.png', '/static/images/logo2.png',
+                   '/static/favicon.ico']
+# sw.js itself is hashed too, otherwise a changed worker would be answered with 304 and never installed
+ASSET_VERSION = get_asset_version(PRECACHE_ASSETS + ['/static/sw.js'])
+# Part of the page ETags, so a deploy changing the views, the markup or the styles isn't hidden behind 304s
+TEMPLATE_VERSION = get_asset_version(['app.py'] + get_template_paths() + PRECACHE_ASSETS)
+# Static files are revalidated by their ETag, the service worker keeps its own versioned copies
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+
+
 @app.route('/sw.js')
 def service_worker():
-    response = make_response(send_from_directory('static', 'sw.js'))
+    with open(os.path.join(app.root_path, 'static', 'sw.js')) as file:
+        script = file.read()
+    script = script.replace('__ASSET_VERSION__', ASSET_VERSION)
+    script = script.replace('__PRECACHE_URLS__', json.dumps(PRECACHE_ASSETS))
+    response = make_response(script)
+    response.headers['Content-Type'] = 'application/javascript'
     response.headers['Cache-Control'] = 'no-cache'
-    return response
+    response.set_etag(ASSET_VERSION)
+    return response.make_conditional(request)
 
 
 @app.route('/OneSignalSDKUpdaterWorker.js')
@@ -122,22 +251,73 @@ def index():
 
 @app.route('/overview/', methods=['GET'])
 @login_required
+@conditional(lambda: leaderboard.get_version())
 def overview():
-    all_users = database_manager.get_all_users()
-    return render_template('pages/overview.html', users=list(all_users))
+    fragment, version = leaderboard.get_fragment()
+    # Only the screens (/overview/?screen=1) get the live updates, the users' tabs would use up the threads
+    return render_template('pages/overview.html', leaderboard=fragment, leaderboard_version=version,
+                           live=request.args.get('screen') == '1')
+
+
+@app.route('/overview/<any(month, quarter, year):window>/', methods=['GET'])
+@login_required
+def overview_window(window):
+    period = database_manager.get_current_period(window)
+    top_users = database_manager.get_top_users(period, TOP_USERS_COUNT)
+    return render_template('pages/top_users.html', users=top_users, window=window, period=period)
+
+
+@app.route('/overview/stream/', methods=['GET'])
+@login_required
+def overview_stream():
+    # EventSource sends the id of the last event it got when it reconnects
+    version = request.headers.get('Last-Event-ID') or request.args.get('version')
+    if not leaderboard_stream_slots.acquire(blocking=False):
+        # Keep the remaining threads for the page requests, the page falls back to reloading
+        return Response('Too many open streams', 503, headers={'Retry-After': str(LEADERBOARD_STREAM_DURATION)})
+    events = leaderboard.iter_changes(version, LEADERBOARD_STREAM_DURATION)
+    response = Response(stream_with_context(format_server_sent_events(events)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Called when the stream ends or the client disconnects
+    response.call_on_close(leaderboard_stream_slots.release)
+    return response
+
+
+def format_server_sent_events(events):
+    for event, version, rows in events:
+        if event == 'ping':
+            yield ': ping\n\n'
+        else:
+            yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(version, event, json.dumps(rows))
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    expected = 'Bearer {}'.format(token).encode('UTF-8')
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode('UTF-8'), expected):
+        abort(401)
+    return Response(Instrumentation.metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/rewards/', methods=['GET', 'POST'])
 @login_required
+@conditional(lambda: database_manager.get_versions(['rewards']))
 def rewards():
     reward_categories = database_manager.get_all_rewards()
-    return render_template('pages/rewards.html', reward_categories=list(reward_categories))
+    versions, _ = database_manager.get_versions(['rewards'])
+    return render_template('pages/rewards.html', reward_categories=list(reward_categories),
+                           rewards_version=versions['rewards'])
 
 
 @app.route('/prizes/', methods=['GET'])
 @login_required
+@conditional(lambda: database_manager.get_versions(['prizes']))
 def prizes():
     prizes_list = list(database_manager.get_all_prizes())
+    # The form's client_token is made by the page script, a token rendered here would be shared through 304s
     return render_template('pages/prizes.html', prizes=prizes_list)
 
 
@@ -145,25 +325,45 @@ def prizes():
 @login_required
 def prizes_request(prize_id):
     email = session['current_user_email']
-    user_points = database_manager.get_user(email)['points']
     prize = database_manager.get_prize(int(prize_id))
-    if int(prize['price']) > user_points:
-        return 'Sorry, it appears you do not have enough points for this prize.'
-    notify_by_mail(email, prize)
-    database_manager.store_request(email, prize_id)
+    try:
+        requested = database_manager.redeem_prize(email, prize_id, request.form.get('client_token'))
+    except NotEnoughPointsException as e:
+        return e.message
+    if requested:
+        notify_by_mail(email, prize)
+        flash('Prize requested.')
+    else:
+        flash('This request was already submitted.')
     update_session()
-    flash('Prize requested.')
     return redirect(url_for('prizes'))
 
 
 def notify_by_mail(user_mail, prize):
     if 'DEBUG' in app.config and not app.config['DEBUG']:
-        server_url = 'https://europe-west1-awesome-email.cloudfunctions.net/sendEmail/'
         message = '{} has requested the \'{}\' prize.'.format(user_mail, prize['description'])
         data_dict = {'name': user_mail, 'subject': 'SynePoints - Prize request', 'email': user_mail, 'message': message}
-        data = json.dumps(data_dict)
-        headers = {"Content-Type": "application/json"}
-        requests.post(server_url, data=data, headers=headers)
+        job_queue.enqueue('mail', data_dict)
+
+
+def send_mail(http_session, data_dict):
+    data = json.dumps(data_dict)
+    headers = {"Content-Type": "application/json"}
+    response = http_session.post(app.config['MAIL_SERVER_URL'], data=data, headers=headers, timeout=MAIL_TIMEOUT)
+    response.raise_for_status()
+
+
+def maintain_ledger(http_session, payload):
+    database_manager.ensure_opening_balances()
+    database_manager.create_balance_snapshots()
+    for email, (points, ledger_points) in database_manager.reconcile_points().items():
+        app.logger.warning('Points of %s drifted from the ledger: %s points, %s in records', email, points,
+                           ledger_points)
+
+
+job_queue = JobQueue(database_manager.db.jobs, {'mail': send_mail, 'ledger': maintain_ledger})
+job_queue.schedule('ledger', LEDGER_MAINTENANCE_INTERVAL)
+job_queue.start()
 
 
 @app.route('/logout/')
@@ -187,18 +387,43 @@ def tasks():
     if not jira_api_token:
         return redirect('/jira/register')
 
-    jira_client = JiraWrapper(server='https://synetech.atlassian.net', basic_auth=(email, jira_api_token))
-    jira_tasks = jira_client.get_tasks_with_transitions()
-
     toggl_api_token = database_manager.get_toggl_api_token(email)
-    current_task_key = ""
+
+    # Jira and toggl are independent, ask both of them at once
+    jira_future = aggregation_executor.submit(Instrumentation.bind_spans(load_jira_tasks), email, jira_api_token)
+    toggl_future = None
     if toggl_api_token:
-        toggl_wrapper = TogglWrapper(toggl_api_token, "SynePoints", SYNETECH_WORKSPACE_ID)
-        current_task_key = toggl_wrapper.get_current_task_key()
+        toggl_future = aggregation_executor.submit(Instrumentation.bind_spans(load_current_task_key), toggl_api_token)
+
+    try:
+        jira_tasks = jira_future.result(timeout=JIRA_TIMEOUT)
+    except TimeoutError:
+        return 'Jira did not respond in time. Please try again later.', 504
+
+    current_task_key = ""
+    if toggl_future:
+        try:
+            current_task_key = toggl_future.result(timeout=TOGGL_TIMEOUT)
+        except TimeoutError:
+            current_task_key = ""
+        except Exception:
+            # A failing toggl (a 403, a non-JSON reply, a deleted task, ...) only means
+            # we can't highlight the running task
+            app.logger.exception('Loading the running toggl task failed')
+            current_task_key = ""
 
     return render_template('pages/tasks.html', tasks=jira_tasks, current_task_key=current_task_key)
 
 
+def load_jira_tasks(email, jira_api_token):
+    jira_client = jira_clients.get((email, jira_api_token))
+    return task_cache.get_tasks(email, jira_client.get_tasks_with_transitions)
+
+
+def load_current_task_key(toggl_api_token):
+    return toggl_clients.get(toggl_api_token).get_current_task_key()
+
+
 @app.route('/jira/register/', methods=['GET', 'POST'])
 @login_required
 def jira_register():
@@ -207,6 +432,8 @@ def jira_register():
             email = session['current_user_email']
             jira_api_token = request.form.get('api_token')
             database_manager.store_jira_api_token(email, jira_api_token)
+            # The cached tasks may belong to the Jira account of the previous token
+            task_cache.invalidate(email)
             return redirect("/tasks")
     return render_template('pages/jira_register.html')
 
@@ -230,7 +457,7 @@ def tasks_stop_timer(task_key):
     toggl_api_token = database_manager.get_toggl_api_token(email)
     if not toggl_api_token:
         return redirect('/toggl/register')
-    toggl_wrapper = TogglWrapper(toggl_api_token, "SynePoints", SYNETECH_WORKSPACE_ID)
+    toggl_wrapper = toggl_clients.get(toggl_api_token)
     toggl_wrapper.stop_time_entry(task_key)
     return redirect("/tasks")
 
@@ -242,7 +469,7 @@ def tasks_start_timer(task_key):
     toggl_api_token = database_manager.get_toggl_api_token(email)
     if not toggl_api_token:
         return redirect('/toggl/register')
-    toggl_wrapper = TogglWrapper(toggl_api_token, "SynePoints", SYNETECH_WORKSPACE_ID)
+    toggl_wrapper = toggl_clients.get(toggl_api_token)
     try:
         toggl_wrapper.start_time_entry(task_key)
     except ProjectNotFoundException as e:
@@ -258,9 +485,9 @@ def tasks_comment(task_key):
     jira_api_token = database_manager.get_jira_api_token(email)
     if not jira_api_token:
         return redirect('/jira/register')
-    options = {'server': 'https://synetech.atlassian.net'}
-    jira_client = JIRA(options, basic_auth=(email, jira_api_token))
+    jira_client = jira_clients.get((email, jira_api_token))
     jira_client.add_comment(task_key, text)
+    # Comments are not rendered on /tasks/, so the cached task list stays valid
     return redirect("/tasks")
 
 
@@ -271,9 +498,10 @@ def tasks_transition(task_key, transition_id):
     jira_api_token = database_manager.get_jira_api_token(email)
     if not jira_api_token:
         return redirect('/jira/register')
-    options = {'server': 'https://synetech.atlassian.net'}
-    jira_client = JIRA(options, basic_auth=(email, jira_api_token))
+    jira_client = jira_clients.get((email, jira_api_token))
     jira_client.transition_issue(task_key, transition_id)
+    # Both the status and the available transitions change, drop the cached list
+    task_cache.invalidate(email)
     return redirect("/tasks")
 
 
@@ -283,12 +511,8 @@ def users_assign_points(assignee_email):
     points = int(request.form['points'])
     reason = request.form['reason']
 
-    resp_json = google.get('/oauth2/v2/userinfo').json()
-    if not resp_json['email']:
-        redirect('/logout')
-    current_user_email = resp_json['email']
-    user = database_manager.get_user(current_user_email)
-    if 'role' in user and (user['role'] == 'admin' or user['role'] == 'pm'):
+    current_user_email = session['current_user_email']
+    if get_current_user_role() in ('admin', 'pm'):
         database_manager.assign_points(assignee_email, points, reason, current_user_email)
     else:
         return 'Not authorized'
@@ -297,26 +521,45 @@ def users_assign_points(assignee_email):
 
 @app.route('/requests/', methods=['GET'])
 @login_required
+@conditional(lambda: database_manager.get_versions(['requests', 'prizes'], fresh=True))
 def requests_list():
     email = session['current_user_email']
-    user_requests = list(database_manager.get_requests(email))
+    after = request.args.get('after')
+    ungranted_after = request.args.get('ungranted_after')
+
+    # One more than the page size tells whether there is a next page
+    user_requests = database_manager.get_requests_with_prizes(email, REQUESTS_PAGE_SIZE + 1, after)
+    next_after = get_next_page_key(user_requests)
     for user_request in user_requests:
-        prize = database_manager.get_prize(user_request['prize_id'])
-        user_request['description'] = prize['description']
-        user_request['price'] = prize['price']
         user_request['date'] = user_request['_id'].generation_time
 
     ungranted_requests = []
-    current_user = database_manager.get_user(email)
-    if 'role' in current_user and current_user['role'] == 'admin':
-        ungranted_requests = list(database_manager.get_ungranted_requests())
+    next_ungranted_after = None
+    if get_current_user_role() == 'admin':
+        ungranted_requests = database_manager.get_ungranted_requests_with_prizes(REQUESTS_PAGE_SIZE + 1,
+                                                                                 ungranted_after)
+        next_ungranted_after = get_next_page_key(ungranted_requests)
         for ungranted_request in ungranted_requests:
-            prize = database_manager.get_prize(ungranted_request['prize_id'])
-            ungranted_request['description'] = prize['description']
             ungranted_request['date'] = ungranted_request['_id'].generation_time
 
+    next_requests_url = None
+    if next_after:
+        next_requests_url = url_for('requests_list', after=next_after, ungranted_after=ungranted_after)
+    next_ungranted_url = None
+    if next_ungranted_after:
+        next_ungranted_url = url_for('requests_list', after=after, ungranted_after=next_ungranted_after)
+
     return render_template('pages/requests.html', requests=user_requests,
-                           ungranted_requests=ungranted_requests)
+                           ungranted_requests=ungranted_requests, next_requests_url=next_requests_url,
+                           next_ungranted_url=next_ungranted_url)
+
+
+def get_next_page_key(page):
+    # Removes the extra request fetched beyond the page size
+    if len(page) > REQUESTS_PAGE_SIZE:
+        del page[REQUESTS_PAGE_SIZE:]
+        return str(page[-1]['_id'])
+    return None
 
 
 @app.route('/requests/<request_id>/cancel/', methods=['POST'])
@@ -330,12 +573,8 @@ def requests_cancel(request_id):
 @app.route('/requests/<request_id>/grant/', methods=['POST'])
 @login_required
 def requests_grant(request_id):
-    resp_json = google.get('/oauth2/v2/userinfo').json()
-    if not resp_json['email']:
-        redirect('/logout')
-    current_user_email = resp_json['email']
-    current_user = database_manager.get_user(current_user_email)
-    if 'role' in current_user and current_user['role'] == 'admin':
+    current_user_email = session['current_user_email']
+    if get_current_user_role() == 'admin':
         database_manager.grant_request(request_id, current_user_email)
     return redirect("/requests")
 
@@ -349,23 +588,24 @@ def assign_points():
         reason = request.form.get('reason')
         points_int = int(points)
 
-        resp_json = google.get('/oauth2/v2/userinfo').json()
-        if not resp_json['email']:
-            redirect('/logout')
-        current_user_email = resp_json['email']
-        current_user = database_manager.get_user(current_user_email)
-        if 'role' in current_user and (current_user['role'] == 'admin' or current_user['role'] == 'pm'):
-            for user_email in include_users:
-                database_manager.assign_points(user_email, points_int, reason, current_user_email)
+        current_user_email = session['current_user_email']
+        if get_current_user_role() in ('admin', 'pm'):
+            database_manager.assign_points_bulk(include_users, points_int, reason, current_user_email)
+            if current_user_email in include_users:
                 update_session()
         else:
             return 'Not authorized'
         flash('Points assigned.')
 
     teams = list(database_manager.get_teams())
-    users = database_manager.get_all_users()
+    users = list(database_manager.get_all_users(database_manager.USER_LIST_FIELDS, USERS_PAGE_SIZE + 1,
+                                                request.args.get('after')))
+    next_users_url = None
+    if len(users) > USERS_PAGE_SIZE:
+        del users[USERS_PAGE_SIZE:]
+        next_users_url = url_for('assign_points', after=database_manager.get_user_page_key(users[-1]))
     return render_template('pages/assign_points.html', teams=list(teams),
-                           users=list(users))
+                           users=users, next_users_url=next_users_url)
 
 
 @app.route('/assign_points/query/', methods=['POST'])
@@ -377,9 +617,9 @@ def assign_points_query():
         name_contains = request.form.get('top_text')
 
     if team_id is not None:
-        filtered_users = database_manager.query_users(name_contains, int(team_id))
+        filtered_users = database_manager.query_users(name_contains, int(team_id), database_manager.USER_LIST_FIELDS)
     else:  # No team selected
-        filtered_users = database_manager.query_users(name_contains)
+        filtered_users = database_manager.query_users(name_contains, projection=database_manager.USER_LIST_FIELDS)
 
     teams = list(database_manager.get_teams())
     return render_template('pages/assign_points.html', teams=list(teams),
@@ -0,0 +1,221 @@
+"""Local HTTP stand-ins for Jira and toggl, answering with payloads shaped like the real ones."""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+JIRA_USERNAME = 'benchmark.user'
+JIRA_PROJECT_KEYS = ('SP', 'FID', 'ORI', 'WEB')
+TRANSITIONS = [
+    {'id': '11', 'name': 'To Do'},
+    {'id': '21', 'name': 'In Progress'},
+    {'id': '31', 'name': 'Code Review'},
+    {'id': '41', 'name': 'Done'},
+]
+TOGGL_WORKSPACE_ID = 689492
+
+
+def make_issue_keys(issue_count):
+    return ['{}-{}'.format(JIRA_PROJECT_KEYS[i % len(JIRA_PROJECT_KEYS)], i + 1) for i in range(issue_count)]
+
+
+class FakeService(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency=0.0):
+        super().__init__(('127.0.0.1', 0), handler_class)
+        # seconds added to every response, to mimic the round trip to the cloud service
+        self.latency = latency
+        self.request_counts = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+    # (method, path regex, handler method name)
+    ROUTES = []
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        url = urlparse(self.path)
+        for route_method, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                self.server.count(name)
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                payload = json.loads(body) if body else None
+                status, data, headers = getattr(self, name)(query, payload, *match.groups())
+                self._send(status, data, headers)
+                return
+        self._send(404, {'errorMessages': ['Not found: {} {}'.format(method, url.path)]})
+
+    def _send(self, status, data, headers=None):
+        body = json.dumps(data).encode('UTF-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeJiraHandler(FakeHandler):
+    ROUTES = [
+        ('GET', r'/rest/api/2/serverInfo', 'server_info'),
+        ('GET', r'/rest/api/2/field', 'fields'),
+        ('GET', r'/rest/api/2/search', 'search'),
+        ('GET', r'/rest/api/2/issue/([^/]+)/transitions', 'transitions'),
+        ('POST', r'/rest/api/2/issue/([^/]+)/transitions', 'transition_issue'),
+        ('POST', r'/rest/api/2/issue/([^/]+)/comment', 'add_comment'),
+    ]
+
+    def server_info(self, query, payload):
+        info = {'baseUrl': self.server.url, 'version': '1001.0.0-SNAPSHOT', 'versionNumbers': [1001, 0, 0],
+                'deploymentType': 'Cloud', 'buildNumber': 100099, 'serverTitle': 'JIRA'}
+        # JIRA.current_user() takes the name from this header
+        return 200, info, {'X-AUSERNAME': JIRA_USERNAME}
+
+    def fields(self, query, payload):
+        return 200, [], None
+
+    def search(self, query, payload):
+        start_at = int(query.get('startAt', 0))
+        # Jira Cloud caps the page size at 100 whatever the client asks for
+        max_results = min(int(query.get('maxResults', 50)), 100)
+        keys = self.server.issue_keys[start_at:start_at + max_results]
+        with_transitions = 'transitions' in query.get('expand', '')
+        issues = [self._issue(key, with_transitions) for key in keys]
+        return 200, {'expand': 'schema,names', 'startAt': start_at, 'maxResults': max_results,
+                     'total': len(self.server.issue_keys), 'issues': issues}, None
+
+    def transitions(self, query, payload, key):
+        return 200, {'expand': 'transitions', 'transitions': [self._transition(t) for t in TRANSITIONS]}, None
+
+    def transition_issue(self, query, payload, key):
+        return 204, None, None
+
+    def add_comment(self, query, payload, key):
+        return 201, {'id': '10000', 'body': (payload or {}).get('body', ''),
+                     'self': '{}/rest/api/2/issue/{}/comment/10000'.format(self.server.url, key),
+                     'author': {'name': JIRA_USERNAME}}, None
+
+    def _issue(self, key, with_transitions):
+        issue_id = str(10000 + int(key.split('-')[1]))
+        issue = {
+            'expand': 'operations,versionedRepresentations,editmeta,changelog,renderedFields',
+            'id': issue_id,
+            'self': '{}/rest/api/2/issue/{}'.format(self.server.url, issue_id),
+            'key': key,
+            'fields': {
+                'summary': 'Implement the screen number {}'.format(key),
+                'status': {'self': '{}/rest/api/2/status/3'.format(self.server.url), 'name': 'In Progress',
+                           'id': '3', 'statusCategory': {'id': 4, 'key': 'indeterminate', 'name': 'In Progress'}},
+                'description': 'As a user I want to see the screen.\n\n' + 'Acceptance criteria. ' * 20,
+                'updated': '2019-02-14T10:{:02d}:00.000+0100'.format(int(key.split('-')[1]) % 60),
+            },
+        }
+        if with_transitions:
+            issue['transitions'] = [self._transition(t) for t in TRANSITIONS]
+        return issue
+
+    def _transition(self, transition):
+        return {'id': transition['id'], 'name': transition['name'], 'hasScreen': False, 'isGlobal': True,
+                'to': {'name': transition['name'], 'id': transition['id']}}
+
+
+class FakeTogglHandler(FakeHandler):
+    ROUTES = [
+        ('GET', r'/workspaces/(\d+)/projects', 'projects'),
+        ('GET', r'/projects/(\d+)/tasks', 'tasks'),
+        ('GET', r'/time_entries/current', 'current_time_entry'),
+        ('POST', r'/time_entries/start', 'start_time_entry'),
+        ('PUT', r'/time_entries/(\d+)/stop', 'stop_time_entry'),
+    ]
+
+    def projects(self, query, payload, workspace_id):
+        return 200, [{'id': project_id, 'wid': int(workspace_id), 'name': '{} Project'.format(key),
+                      'active': True, 'is_private': False, 'billable': True}
+                     for key, project_id in self._project_ids().items()], None
+
+    def tasks(self, query, payload, project_id):
+        project_id = int(project_id)
+        return 200, [self._task(key) for key in self.server.issue_keys
+                     if self._project_ids()[key.split('-')[0]] == project_id], None
+
+    def current_time_entry(self, query, payload):
+        return 200, {'data': self.server.current_entry}, None
+
+    def start_time_entry(self, query, payload):
+        entry = dict(payload['time_entry'], id=self._next_entry_id(), wid=TOGGL_WORKSPACE_ID,
+                     start='2019-02-14T09:00:00+00:00', duration=-int(time.time()))
+        self.server.current_entry = entry
+        return 200, {'data': entry}, None
+
+    def stop_time_entry(self, query, payload, entry_id):
+        entry = self.server.current_entry
+        self.server.current_entry = None
+        return 200, {'data': dict(entry or {}, id=int(entry_id), duration=60)}, None
+
+    def _project_ids(self):
+        return {key: 1000 + i for i, key in enumerate(JIRA_PROJECT_KEYS)}
+
+    def _task(self, key):
+        return {'id': 100000 + int(key.split('-')[1]), 'pid': self._project_ids()[key.split('-')[0]],
+                'wid': TOGGL_WORKSPACE_ID, 'name': '{} Implement the screen'.format(key), 'active': True}
+
+    def _next_entry_id(self):
+        with self.server.lock:
+            self.server.last_entry_id += 1
+            return self.server.last_entry_id
+
+
+def start_jira(issue_count, latency=0.0):
+    server = FakeService(FakeJiraHandler, latency)
+    server.issue_keys = make_issue_keys(issue_count)
+    return server.start()
+
+
+def start_toggl(issue_count, latency=0.0):
+    server = FakeService(FakeTogglHandler, latency)
+    server.issue_keys = make_issue_keys(issue_count)
+    server.current_entry = None
+    server.last_entry_id = 500000000
+    return server.start()
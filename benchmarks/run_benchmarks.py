@@ -0,0 +1,348 @@
+"""Measures the latency and throughput of the main pages against local stand-ins of Mongo, Jira and toggl.
+
+    python -m benchmarks.run_benchmarks --users 500 --records 20000 --issues 200
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/20190301-120000.json
+
+Needs a local mongod (--mongo-uri) or mongomock (--mongomock). The benchmark database is dropped on every run.
+mongomock has no change streams, the leaderboard logs that once and polls instead.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from cryptography.fernet import Fernet
+
+from benchmarks import fake_services
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+DATABASE_NAME = 'SynePointsBenchmark'
+BENCHMARK_EMAIL = 'benchmark.user@synetech.cz'
+TEAM_COUNT = 8
+PRIZE_COUNT = 12
+REWARD_CATEGORY_COUNT = 5
+ASSIGNED_USERS_COUNT = 5
+# a change of p50/p95 latency or throughput worse than this (in percent) is reported as a regression
+DEFAULT_REGRESSION_THRESHOLD = 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--records', type=int, default=5000, help='ledger records spread over the users')
+    parser.add_argument('--requests', type=int, default=300, help='prize requests spread over the users')
+    parser.add_argument('--issues', type=int, default=150, help='Jira issues assigned to the benchmark user')
+    parser.add_argument('--iterations', type=int, default=50, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=3, help='unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='clients sending requests at once')
+    parser.add_argument('--jira-latency', type=float, default=0.05, help='seconds added to every Jira response')
+    parser.add_argument('--toggl-latency', type=float, default=0.03, help='seconds added to every toggl response')
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_DATABASE_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--mongomock', action='store_true', help='use mongomock instead of a running mongod')
+    parser.add_argument('--task-cache-ttl', type=int, help='seconds, 0 loads the Jira tasks on every request')
+    parser.add_argument('--task-cache-backend', choices=('mongo', 'memory'))
+    parser.add_argument('--scenarios', nargs='*', help='names of the scenarios to run, all by default')
+    parser.add_argument('--output', help='where to save the results, benchmarks/results/<time>.json by default')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
+def configure_environment(args, jira, toggl):
+    # config.Config reads these when app is imported
+    os.environ['APP_SETTINGS'] = 'config.TestingConfig'
+    os.environ.setdefault('SECRET_KEY', Fernet.generate_key().decode('UTF-8'))
+    os.environ.setdefault('MONGO_USER', 'benchmark')
+    os.environ.setdefault('MONGO_PASSWORD', 'benchmark')
+    os.environ['MONGO_DATABASE_URI'] = args.mongo_uri
+    os.environ['JIRA_SERVER'] = jira.url
+    os.environ['TOGGL_API_URL'] = toggl.url
+    # Only log the slow requests, which the stand-ins shouldn't produce
+    os.environ.setdefault('SLOW_REQUEST_THRESHOLD', '60000')
+    if args.task_cache_ttl is not None:
+        os.environ['TASK_CACHE_TTL'] = str(args.task_cache_ttl)
+    if args.task_cache_backend:
+        os.environ['TASK_CACHE_BACKEND'] = args.task_cache_backend
+
+    if args.mongomock:
+        import mongomock
+        # Must be patched before DatabaseManager imports MongoClient
+        mongomock.patch(servers=((_mongo_host(args.mongo_uri), 27017),)).start()
+
+    # app.py opens client_id.json relative to the working directory
+    os.chdir(ROOT_DIR)
+    sys.path.insert(0, ROOT_DIR)
+
+
+def _mongo_host(uri):
+    return uri.split('://', 1)[-1].split('/')[0].split(':')[0] or 'localhost'
+
+
+def seed_database(args):
+    """Fills the benchmark database with generated users, ledger records, prize requests and catalogs."""
+    from DatabaseManager import DatabaseManager, get_search_tokens
+    DatabaseManager.DATABASE_NAME = DATABASE_NAME
+    if args.mongomock:
+        # mongomock has neither the ismaster command nor sessions, write like against a standalone mongod
+        DatabaseManager._supports_transactions = lambda database_manager: False
+
+    rng = random.Random(args.seed)
+    database_manager = DatabaseManager(args.mongo_uri, os.environ['SECRET_KEY'])
+    database_manager.client.drop_database(DATABASE_NAME)
+    database_manager.ensure_indexes()
+    db = database_manager.db
+
+    teams = [{'id': team_id, 'name': 'Team {}'.format(team_id)} for team_id in range(1, TEAM_COUNT + 1)]
+    db.teams.insert_many(teams)
+
+    users = [{'email': BENCHMARK_EMAIL, 'fullname': 'Benchmark User', 'role': 'admin', 'points': 0,
+              'team': [1]}]
+    for i in range(args.users - 1):
+        users.append({'email': 'user.{}@synetech.cz'.format(i), 'fullname': 'Uživatel Číslo {}'.format(i),
+                      'role': rng.choice(('user', 'user', 'user', 'pm')), 'points': 0,
+                      'team': rng.sample(range(1, TEAM_COUNT + 1), rng.randint(0, 2))})
+
+    points = {user['email']: 0 for user in users}
+    records = []
+    for _ in range(args.records):
+        email = rng.choice(users)['email']
+        record_points = rng.randint(1, 50)
+        points[email] += record_points
+        records.append({'change_by': BENCHMARK_EMAIL, 'user': email, 'reason': 'Benchmark', 'points': record_points})
+    if records:
+        database_manager.store_records(records)
+
+    for user in users:
+        user['points'] = points[user['email']]
+        user['search_tokens'] = get_search_tokens(user)
+    db.users.insert_many(users)
+
+    for prize_id in range(PRIZE_COUNT):
+        database_manager.store_prize({'id': prize_id, 'requestable': prize_id > 0,
+                                      'description': 'Odměna číslo {}'.format(prize_id),
+                                      'price': str(10 * (prize_id + 1))})
+    for category_id in range(REWARD_CATEGORY_COUNT):
+        database_manager.store_rewards_category({'name': 'KATEGORIE {}'.format(category_id), 'rewards': [
+            {'description': 'Aktivita {} v kategorii {}'.format(i, category_id), 'points': str(5 * (i + 1))}
+            for i in range(6)]})
+
+    # with the client_token the prize form sends since the redemptions are idempotent
+    prize_requests = [{'email': rng.choice(users)['email'], 'prize_id': rng.randrange(1, PRIZE_COUNT),
+                       'granted': rng.random() < 0.7, 'client_token': '{:032x}'.format(rng.getrandbits(128))}
+                      for _ in range(args.requests)]
+    if prize_requests:
+        db.requests.insert_many(prize_requests)
+
+    database_manager._invalidate_catalog('teams')
+    database_manager._bump_version('requests')
+
+    database_manager.store_jira_api_token(BENCHMARK_EMAIL, 'jira-benchmark-token')
+    database_manager.store_toggl_api_token(BENCHMARK_EMAIL, 'toggl-benchmark-token')
+    return [user['email'] for user in users]
+
+
+class Scenario:
+
+    def __init__(self, name, method, path, data=None, prepare=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        # unmeasured request sent before every measured one, e.g. starting the timer that is then stopped
+        self.prepare = prepare
+
+
+def get_scenarios(emails, issue_keys):
+    assigned_users = emails[1:ASSIGNED_USERS_COUNT + 1]
+    task_key = issue_keys[0] if issue_keys else 'SP-1'
+    start_timer = ('POST', '/tasks/{}/start/'.format(task_key))
+    return [
+        Scenario('overview', 'GET', '/overview/'),
+        Scenario('tasks', 'GET', '/tasks/'),
+        Scenario('requests', 'GET', '/requests/'),
+        Scenario('assign_points', 'GET', '/assign_points/'),
+        Scenario('assign_points_submit', 'POST', '/assign_points/',
+                 data={'include_checkbox': assigned_users, 'points': '1', 'reason': 'Benchmark'}),
+        Scenario('start_timer', *start_timer),
+        Scenario('stop_timer', 'POST', '/tasks/{}/stop/'.format(task_key), prepare=start_timer),
+    ]
+
+
+def make_client(flask_app):
+    client = flask_app.test_client()
+    with client.session_transaction() as session:
+        # What flask-dance and the google login leave in the session
+        session['google_oauth_token'] = {'access_token': 'benchmark-token', 'token_type': 'Bearer'}
+        session['current_user_email'] = BENCHMARK_EMAIL
+        session['current_user_role'] = 'admin'
+        session['current_user_points'] = 0
+        session['current_user_loaded_at'] = 0
+    return client
+
+
+def parse_server_timing(header):
+    """'mongo;dur=1.5;desc="3 calls", total;dur=4.0' -> {'mongo': 1.5, 'total': 4.0}"""
+    timings = {}
+    for metric in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, *params = metric.split(';')
+        for param in params:
+            if param.startswith('dur='):
+                timings[name] = float(param[4:])
+    return timings
+
+
+def percentile(sorted_values, fraction):
+    # nearest rank
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(flask_app, scenario, args):
+    clients = [make_client(flask_app) for _ in range(args.concurrency)]
+
+    def send(client, method, path, data=None):
+        return client.open(path, method=method, data=data)
+
+    def measure(client, count):
+        samples = []
+        for _ in range(count):
+            if scenario.prepare:
+                send(client, *scenario.prepare)
+            start = time.perf_counter()
+            response = send(client, scenario.method, scenario.path, scenario.data)
+            duration = time.perf_counter() - start
+            samples.append((duration, response.status_code, parse_server_timing(response.headers.get('Server-Timing'))))
+        return samples
+
+    measure(clients[0], args.warmup)
+
+    counts = [args.iterations // args.concurrency + (1 if i < args.iterations % args.concurrency else 0)
+              for i in range(args.concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        samples = [sample for worker_samples in executor.map(measure, clients, counts) for sample in worker_samples]
+    wall_time = time.perf_counter() - start
+    return summarize(samples, wall_time)
+
+
+def summarize(samples, wall_time):
+    durations = sorted(duration * 1000 for duration, _, _ in samples)
+    server_timing = {}
+    for _, _, timings in samples:
+        for name, duration in timings.items():
+            server_timing.setdefault(name, []).append(duration)
+    return {
+        'count': len(samples),
+        'errors': sum(1 for _, status, _ in samples if status >= 400),
+        'statuses': sorted(set(status for _, status, _ in samples)),
+        'p50_ms': percentile(durations, 0.5),
+        'p95_ms': percentile(durations, 0.95),
+        'mean_ms': sum(durations) / len(durations) if durations else None,
+        'max_ms': durations[-1] if durations else None,
+        'throughput_rps': len(samples) / wall_time if wall_time else None,
+        # mean time per request spent in mongo, jira, toggl, fernet and templates, as reported by the app
+        'server_timing_ms': {name: sum(values) / len(values) for name, values in sorted(server_timing.items())},
+    }
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode('UTF-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+
+def print_results(results):
+    print('{:<22} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10}'.format('scenario', 'count', 'errors', 'p50 ms', 'p95 ms',
+                                                                  'max ms', 'req/s'))
+    for name, result in results['scenarios'].items():
+        print('{:<22} {:>6} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            name, result['count'], result['errors'], result['p50_ms'], result['p95_ms'], result['max_ms'],
+            result['throughput_rps']))
+
+
+def compare_results(previous, current, threshold):
+    """Prints the change against an earlier run and returns the names of the regressed scenarios."""
+    if previous['parameters'] != current['parameters']:
+        print('Warning: the runs used different parameters, the comparison may be misleading')
+    print('{:<22} {:>18} {:>18} {:>18}'.format('scenario', 'p50 change', 'p95 change', 'req/s change'))
+    regressions = []
+    for name, result in current['scenarios'].items():
+        before = previous['scenarios'].get(name)
+        if before is None:
+            continue
+        changes = [_change(before[key], result[key]) for key in ('p50_ms', 'p95_ms', 'throughput_rps')]
+        # Higher latency or lower throughput is worse
+        if changes[0] > threshold or changes[1] > threshold or changes[2] < -threshold:
+            regressions.append(name)
+        print('{:<22} {:>17.1f}% {:>17.1f}% {:>17.1f}%{}'.format(name, *changes,
+                                                                 '  REGRESSION' if name in regressions else ''))
+    return regressions
+
+
+def _change(before, after):
+    if not before:
+        return 0.0
+    return (after - before) / before * 100
+
+
+def main():
+    args = parse_args()
+    jira = fake_services.start_jira(args.issues, args.jira_latency)
+    toggl = fake_services.start_toggl(args.issues, args.toggl_latency)
+    try:
+        configure_environment(args, jira, toggl)
+        emails = seed_database(args)
+        import app
+
+        scenarios = get_scenarios(emails, jira.issue_keys)
+        if args.scenarios:
+            scenarios = [scenario for scenario in scenarios if scenario.name in args.scenarios]
+
+        results = {
+            'created_at': datetime.utcnow().isoformat(),
+            'revision': get_git_revision(),
+            'python': platform.python_version(),
+            'parameters': {key: getattr(args, key) for key in (
+                'users', 'records', 'requests', 'issues', 'iterations', 'concurrency', 'jira_latency',
+                'toggl_latency', 'mongomock', 'task_cache_ttl', 'task_cache_backend')},
+            'scenarios': {},
+        }
+        for scenario in scenarios:
+            results['scenarios'][scenario.name] = run_scenario(app.app, scenario, args)
+        results['fake_service_calls'] = {'jira': dict(jira.request_counts), 'toggl': dict(toggl.request_counts)}
+    finally:
+        jira.stop()
+        toggl.stop()
+
+    output = args.output or os.path.join(RESULTS_DIR, '{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    save_results(results, output)
+    print_results(results)
+    print('Saved to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+        if compare_results(previous, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,20 @@ class Config(object):
     SECRET_KEY = os.environ['SECRET_KEY']
     MONGO_USER = os.environ['MONGO_USER']
     MONGO_PASSWORD = os.environ['MONGO_PASSWORD']
-    MONGO_DATABASE_URI = "mongodb+srv://{}:{}@synepoints-f8xsm.mongodb.net/test".format(MONGO_USER, MONGO_PASSWORD)
+    MONGO_DATABASE_URI = os.environ.get('MONGO_DATABASE_URI', "mongodb+srv://{}:{}@synepoints-f8xsm.mongodb.net/test"
+                                        .format(MONGO_USER, MONGO_PASSWORD))
+    # can point to local stand-ins, see benchmarks/
+    JIRA_SERVER = os.environ.get('JIRA_SERVER', 'https://synetech.atlassian.net')
+    TOGGL_API_URL = os.environ.get('TOGGL_API_URL')
+    # 'memory' keeps the Jira task cache per process, 'mongo' shares it between gunicorn workers
+    TASK_CACHE_BACKEND = os.environ.get('TASK_CACHE_BACKEND', 'mongo')
+    TASK_CACHE_TTL = int(os.environ.get('TASK_CACHE_TTL', 300))
+    MAIL_SERVER_URL = os.environ.get('MAIL_SERVER_URL',
+                                     'https://europe-west1-awesome-email.cloudfunctions.net/sendEmail/')
+    # milliseconds, slower requests are logged with their spans
+    SLOW_REQUEST_THRESHOLD = int(os.environ.get('SLOW_REQUEST_THRESHOLD', 1000))
+    # /metrics needs 'Authorization: Bearer <METRICS_TOKEN>' and is disabled without the token
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
 
 
 class ProductionConfig(Config):
@@ -27,6 +40,7 @@ class DevelopmentConfig(Config):
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
     DEVELOPMENT = True
     DEBUG = True
+    TASK_CACHE_BACKEND = 'memory'
 
 
 class TestingConfig(Config):
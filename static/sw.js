@@ -1,26 +1,101 @@
 importScripts('https://cdn.onesignal.com/sdks/OneSignalSDKWorker.js');
 
-// Listen for install event, set callback
+// Filled in by Flask when serving this file, the version changes with the content of the precached assets
+const ASSET_VERSION = '__ASSET_VERSION__';
+const PRECACHE_URLS = __PRECACHE_URLS__;
+
+const STATIC_CACHE = 'synepoints-static-' + ASSET_VERSION;
+const PAGES_CACHE = 'synepoints-pages-' + ASSET_VERSION;
+const PAGES_CACHE_MAX_ENTRIES = 20;
+// Pages served from the cache right away and refreshed in the background
+const STALE_WHILE_REVALIDATE_PATHS = ['/overview/', '/prizes/', '/rewards/'];
+
 self.addEventListener('install', function (event) {
-    console.log('Super install', event)
+    event.waitUntil(
+        caches.open(STATIC_CACHE).then(function (cache) {
+            // Bypass the HTTP cache, so that the new version really gets the new files
+            return cache.addAll(PRECACHE_URLS.map(function (url) {
+                return new Request(url, {cache: 'reload'});
+            }));
+        }).then(function () {
+            return self.skipWaiting();
+        })
+    );
 });
 
 self.addEventListener('activate', function (event) {
-    console.log('Super activate', event)
+    event.waitUntil(
+        caches.keys().then(function (cacheNames) {
+            return Promise.all(cacheNames.filter(function (cacheName) {
+                return cacheName !== STATIC_CACHE && cacheName !== PAGES_CACHE;
+            }).map(function (cacheName) {
+                return caches.delete(cacheName);
+            }));
+        }).then(function () {
+            return self.clients.claim();
+        })
+    );
 });
 
 self.addEventListener('fetch', function (event) {
-    console.log('Super fetch', event)
-    event.respondWith(
-        caches.open('mysite-dynamic').then(function (cache) {
-            return cache.match(event.request).then(function (response) {
-                return response || fetch(event.request).then(function (response) {
-                    console.log('response fetch', event)
-                    cache.put(event.request, response.clone());
-                    console.log('put fetch', event)
-                    return response;
-                });
-            });
-        })
-    );
+    const request = event.request;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) {
+        return;
+    }
+
+    if (request.method !== 'GET' || url.pathname === '/logout/') {
+        // Points or the user may change, don't show the cached pages anymore
+        event.waitUntil(caches.delete(PAGES_CACHE));
+        return;
+    }
+
+    if (PRECACHE_URLS.indexOf(url.pathname) !== -1) {
+        event.respondWith(
+            caches.match(request, {cacheName: STATIC_CACHE}).then(function (response) {
+                return response || fetch(request);
+            })
+        );
+        return;
+    }
+
+    if (STALE_WHILE_REVALIDATE_PATHS.indexOf(url.pathname) !== -1) {
+        event.respondWith(staleWhileRevalidate(event));
+    }
+    // Everything else goes to the network as usual
 });
+
+function staleWhileRevalidate(event) {
+    return caches.open(PAGES_CACHE).then(function (cache) {
+        return cache.match(event.request).then(function (cached) {
+            const network = fetch(event.request).then(function (response) {
+                // Don't cache the login redirects or errors
+                if (response.ok && !response.redirected) {
+                    return putWithLimit(cache, event.request, response.clone()).then(function () {
+                        return response;
+                    });
+                }
+                return response;
+            });
+            if (cached) {
+                event.waitUntil(network.catch(function () {
+                }));
+                return cached;
+            }
+            return network;
+        });
+    });
+}
+
+function putWithLimit(cache, request, response) {
+    // Deleting first moves the entry to the end, so the keys are ordered from the least recently updated
+    return cache.delete(request).then(function () {
+        return cache.put(request, response);
+    }).then(function () {
+        return cache.keys();
+    }).then(function (keys) {
+        return Promise.all(keys.slice(0, Math.max(0, keys.length - PAGES_CACHE_MAX_ENTRIES)).map(function (key) {
+            return cache.delete(key);
+        }));
+    });
+}
@@ -0,0 +1,131 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from bson import ObjectId
+from cryptography.fernet import Fernet
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from DatabaseManager import DatabaseManager
+
+
+def record_id(moment, sequence=0):
+    return ObjectId(ObjectId.from_datetime(moment).binary[:4] + sequence.to_bytes(8, 'big'))
+
+
+@unittest.skipIf(mongomock is None, 'needs mongomock')
+class LedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        for patcher in (mock.patch('DatabaseManager.MongoClient', mongomock.MongoClient),
+                        # mongomock has neither the ismaster command nor sessions
+                        mock.patch.object(DatabaseManager, '_supports_transactions', return_value=False)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.database_manager = DatabaseManager('mongodb://localhost', Fernet.generate_key())
+        self.database_manager.client.drop_database(DatabaseManager.DATABASE_NAME)
+        self.db = self.database_manager.db
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.sequence = 0
+
+    def add_record(self, user, points, hours_ago):
+        # Several records of one second differ in the rest of the ObjectId
+        self.sequence += 1
+        self.db.records.insert_one({'_id': record_id(self.now - timedelta(hours=hours_ago), self.sequence),
+                                    'change_by': 'admin', 'user': user, 'points': points})
+
+    def add_snapshot(self, hours_ago, balances):
+        run = record_id(self.now - timedelta(hours=hours_ago), 2 ** 64 - 1)
+        self.db.balance_snapshots.insert_many([{'run': run, 'user': user, 'points': points}
+                                               for user, points in balances.items()])
+
+    def test_balance_without_snapshot_sums_the_ledger(self):
+        self.add_record('a', 10, 5)
+        self.add_record('a', -3, 4)
+        self.add_record('b', 7, 3)
+        self.assertEqual(self.database_manager.get_balance('a'), 7)
+        self.assertEqual(self.database_manager.get_balances(), {'a': 7, 'b': 7})
+
+    def test_balance_is_snapshot_plus_tail(self):
+        # Records up to the snapshot are only counted through it
+        self.add_record('a', 1000, 10)
+        self.add_snapshot(8, {'a': 10, 'b': 4})
+        self.add_record('a', 5, 6)
+        self.add_record('b', -4, 5)
+        self.add_record('c', 2, 4)
+        self.assertEqual(self.database_manager.get_balances(), {'a': 15, 'b': 0, 'c': 2})
+        self.assertEqual(self.database_manager.get_balance('a'), 15)
+
+    def test_balance_in_the_past_ignores_later_records_and_snapshots(self):
+        self.add_snapshot(8, {'a': 10})
+        self.add_record('a', 5, 6)
+        self.add_snapshot(4, {'a': 1000})
+        self.add_record('a', 1, 2)
+        at = self.now - timedelta(hours=5)
+        self.assertEqual(self.database_manager.get_balance('a', at), 15)
+        self.assertEqual(self.database_manager.get_balances(at), {'a': 15})
+        self.assertEqual(self.database_manager.get_balance('a'), 1001)
+
+    def test_records_of_the_boundary_second_are_included(self):
+        self.add_record('a', 3, 1)
+        self.assertEqual(self.database_manager.get_balance('a', self.now - timedelta(hours=1)), 3)
+
+    def test_leaderboard_at(self):
+        self.add_record('a', 5, 3)
+        self.add_record('b', 9, 3)
+        self.add_record('c', 5, 3)
+        self.add_record('b', -9, 1)
+        self.assertEqual(self.database_manager.get_leaderboard_at(self.now - timedelta(hours=2)),
+                         [('b', 9), ('a', 5), ('c', 5)])
+
+    def test_first_snapshot_is_seeded_from_the_counters(self):
+        # Legacy records: no opening balance and a grant deducted twice
+        self.db.users.insert_one({'email': 'a', 'fullname': 'A', 'points': 20})
+        self.add_record('a', 50, 10)
+        self.add_record('a', -40, 9)
+        self.assertEqual(self.database_manager.reconcile_points(), {'a': (20, 10)})
+
+        self.database_manager.create_balance_snapshots()
+        self.assertEqual(self.database_manager.reconcile_points(), {})
+
+        self.database_manager.assign_points('a', 5, 'Bonus', 'admin')
+        self.assertEqual(self.database_manager.get_balance('a'), 25)
+        self.assertEqual(self.database_manager.reconcile_points(), {})
+
+    def test_users_added_by_hand_get_an_opening_balance(self):
+        self.db.users.insert_many([{'email': 'a', 'fullname': 'A', 'points': 20},
+                                   {'email': 'b', 'fullname': 'B', 'points': 7}])
+        # b got points before the backfill ran
+        self.add_record('b', 5, 1)
+        self.database_manager.ensure_opening_balances()
+        self.assertEqual(self.database_manager.reconcile_points(), {})
+        self.assertEqual(self.database_manager.get_balances(), {'a': 20, 'b': 7})
+
+        # Running it again doesn't add more records
+        self.database_manager.ensure_opening_balances()
+        self.assertEqual(self.db.records.count_documents({}), 3)
+
+    def test_users_in_a_snapshot_get_no_opening_balance(self):
+        self.db.users.insert_one({'email': 'a', 'fullname': 'A', 'points': 20})
+        self.database_manager.create_balance_snapshots()
+        self.database_manager.ensure_opening_balances()
+        self.assertEqual(self.db.records.count_documents({}), 0)
+        self.assertEqual(self.database_manager.get_balance('a'), 20)
+
+    def test_points_buckets_are_rebuilt_from_awards(self):
+        self.add_record('a', 5, 1)
+        self.add_record('a', 3, 1)
+        self.db.records.insert_one({'change_by': 'a', 'user': 'a', 'request_id': ObjectId(), 'points': -50})
+        self.db.records.insert_one({'change_by': None, 'user': 'a', 'reason': 'Opening balance', 'points': 100})
+        self.database_manager.ensure_points_buckets()
+        for period in DatabaseManager.get_periods(self.now - timedelta(hours=1)):
+            self.assertEqual(self.database_manager.get_top_users(period),
+                             [{'email': 'a', 'fullname': 'a', 'points': 8}])
+
+
+if __name__ == '__main__':
+    unittest.main()